@@ -37,7 +37,7 @@ export async function POST(request: NextRequest) {
     let text: string
     try {
       console.log("Attempting to call PDF RAG system for:", message)
-      const ragResponse = await callPythonRAG(message)
+      const ragResponse = await callPythonRAG(message, userId)
       console.log("PDF RAG response received:", ragResponse)
       text = ragResponse.answer || generateMockResponse(message, context, retrievalResults)
     } catch (error) {
@@ -291,12 +291,54 @@ Debt consolidation can be helpful if you can get a lower interest rate, but be c
 Please ask me specific questions about any of these areas, and I'll provide detailed guidance with citations from your documents.`
 }
 
-async function callPythonRAG(question: string): Promise<{ answer: string; citations?: any[]; confidence?: number }> {
+// Warm RAG server started with `financial-rag.py --serve`; reused across requests when reachable
+const RAG_SERVER_URL = process.env.RAG_SERVER_URL || "http://127.0.0.1:8765"
+
+// The server stops work on its own at timeout_s, a little before our fetch gives up
+const RAG_TIMEOUT_MS = 30000
+
+// Server is up but shedding load (429) or ran out of time (504): spawning a fresh process would
+// only add more load, so these are not retried through the CLI fallback
+class RAGServerBusyError extends Error {}
+
+// The server searches the shared corpus plus this user's own index overlay, if they have one
+async function callRAGServer(question: string, userId: string): Promise<{ answer: string; citations?: any[]; confidence?: number }> {
+  const response = await fetch(`${RAG_SERVER_URL}/ask`, {
+    method: "POST",
+    headers: { "Content-Type": "application/json", "x-user-id": userId },
+    body: JSON.stringify({ question, user_id: userId, timeout_s: (RAG_TIMEOUT_MS - 2000) / 1000 }),
+    signal: AbortSignal.timeout(RAG_TIMEOUT_MS),
+  })
+  if (response.status === 429 || response.status === 504) {
+    throw new RAGServerBusyError(`RAG server returned ${response.status}`)
+  }
+  if (!response.ok) {
+    throw new Error(`RAG server returned ${response.status}`)
+  }
+  const data = await response.json()
+  const hits: any[] = data.hits || []
+  return {
+    answer: data.answer,
+    citations: hits.map((hit) => ({ source: hit.source, page: hit.page + 1, relevanceScore: hit.score })),
+    confidence: hits.length ? Math.min(hits[0].score, 1.0) : 0,
+  }
+}
+
+async function callPythonRAG(question: string, userId: string): Promise<{ answer: string; citations?: any[]; confidence?: number }> {
+  try {
+    return await callRAGServer(question, userId)
+  } catch (error) {
+    if (error instanceof RAGServerBusyError) {
+      throw error
+    }
+    console.log("RAG server unavailable, spawning financial-rag.py:", error)
+  }
+
   return new Promise((resolve, reject) => {
     // Call financial-rag.py using the virtual environment
     const scriptPath = path.join(process.cwd(), 'scripts', 'financial-rag.py')
     const venvPython = path.join(process.cwd(), 'venv', 'bin', 'python')
-    const pythonProcess = spawn(venvPython, [scriptPath, '--ask', question])
+    const pythonProcess = spawn(venvPython, [scriptPath, '--ask', question, '--tenant', userId])
     
     let output = ''
     let errorOutput = ''
@@ -4,16 +4,83 @@
 # - Build index once: python fast_rag.py --build
 # - Ask a question:   python fast_rag.py --ask "Your question"
 # - REPL mode:        python fast_rag.py
+# - Serve (warm):     python fast_rag.py --serve --port 8765
+# - First run:        python fast_rag.py --setup   (installs deps, HF login)
 # ==========================================================
 
-import os, sys, io, re, time, glob, json, hashlib, pickle, warnings, subprocess, importlib, argparse
+from __future__ import annotations
+import time
+_T_START = time.perf_counter()
+import os, sys, io, re, glob, json, shutil, hashlib, pickle, tempfile, warnings, subprocess, importlib, argparse, threading, queue, zlib, asyncio
+from collections import deque, OrderedDict, Counter
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
+from itertools import islice
 from dataclasses import dataclass
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from typing import List, Optional, Tuple
 from dotenv import load_dotenv
 load_dotenv()  # Load environment variables from .env file
 warnings.filterwarnings("ignore")
 
-# ---------------- Safe installer ----------------
+# ---------------- Lazy imports ----------------
+# Heavy modules are imported on first attribute access, so a command only pays for the
+# subsystems it actually uses (index inspection never imports torch, the LM stack stays out of
+# --build). Once loaded, the proxy replaces itself in globals() and costs nothing afterwards.
+IMPORT_TIMES_MS: dict = {}
+_IMPORT_LOCK = threading.RLock()
+
+def _import(module: str):
+    if module in sys.modules:
+        return sys.modules[module]
+    t0 = time.perf_counter()
+    try:
+        mod = importlib.import_module(module)
+    except ImportError as e:
+        raise ImportError(f"{e} (install dependencies with: python {os.path.basename(__file__)} --setup)") from e
+    IMPORT_TIMES_MS[module] = round((time.perf_counter() - t0) * 1000, 1)
+    return mod
+
+class _LazyModule:
+    def __init__(self, module: str, alias: str, on_load=None):
+        self._module, self._alias, self._on_load = module, alias, on_load
+
+    def __getattr__(self, attr):
+        with _IMPORT_LOCK:
+            mod = _import(self._module)
+            if globals().get(self._alias) is self:
+                globals()[self._alias] = mod
+                if self._on_load:
+                    self._on_load()
+        return getattr(mod, attr)
+
+np = _LazyModule("numpy", "np")
+torch = _LazyModule("torch", "torch", on_load=lambda: setup_torch())
+transformers = _LazyModule("transformers", "transformers")
+
+HF_TOKEN = os.getenv("HF_TOKEN")
+
+def _pdf_reader():
+    try:
+        return _import("pypdf").PdfReader
+    except ImportError:
+        return _import("PyPDF2").PdfReader
+
+# ---------------- Setup (explicit; never on the query path) ----------------
+# `--setup` installs missing dependencies and logs in to the HuggingFace Hub once. Normal runs
+# only import what they need and fail with a pointer to --setup if something is missing.
+REQUIREMENTS = [
+    ("torch", "torch>=2.2"),
+    ("transformers", "transformers==4.44.2"),  # pinned to avoid GenMixin issues
+    ("tokenizers", "tokenizers>=0.19.1"),
+    ("numpy", "numpy>=1.26"),
+    ("accelerate", "accelerate>=0.33.0"),
+    ("pypdf", "pypdf"),
+    ("sentence_transformers", "sentence-transformers>=2.7.0"),
+    ("fitz", "PyMuPDF"),
+]
+
 def _ensure(mod_name: str, pip_spec: Optional[str] = None):
     try:
         return importlib.import_module(mod_name)
@@ -22,39 +89,14 @@ def _ensure(mod_name: str, pip_spec: Optional[str] = None):
         subprocess.check_call([sys.executable, "-m", "pip", "install", "-q", "--no-cache-dir", spec])
         return importlib.import_module(mod_name)
 
-# Core deps (pin transformers to avoid GenMixin issues)
-torch = _ensure("torch", "torch>=2.2")
-transformers = _ensure("transformers", "transformers==4.44.2")
-tokenizers = _ensure("tokenizers", "tokenizers>=0.19.1")
-np = _ensure("numpy", "numpy>=1.26")
-accelerate = _ensure("accelerate", "accelerate>=0.33.0")
-
-from transformers import AutoTokenizer, AutoModelForCausalLM
-
-# Optional HF login
-HF_TOKEN = os.getenv("HF_TOKEN")
-try:
-    from huggingface_hub import login
-    if HF_TOKEN: login(token=HF_TOKEN)
-except Exception:
-    pass
-
-# PDFs (pypdf fallback)
-try:
-    from pypdf import PdfReader
-except Exception:
-    try:
-        from PyPDF2 import PdfReader
-    except Exception:
-        _ensure("pypdf", "pypdf")
-        from pypdf import PdfReader
-
-# sentence-transformers
-try:
-    from sentence_transformers import SentenceTransformer
-except Exception:
-    _ensure("sentence-transformers", "sentence-transformers>=2.7.0")
-    from sentence_transformers import SentenceTransformer
+def run_setup():
+    for mod, spec in REQUIREMENTS:
+        _ensure(mod, spec)
+        print(f"✅ {spec}")
+    if HF_TOKEN:
+        from huggingface_hub import login
+        login(token=HF_TOKEN)
+        print("🔑 Logged in to the HuggingFace Hub")
 
 
 # ---------------- Configuration ----------------
@@ -67,12 +109,32 @@ class Config:
     CACHE_DIR: str = "./rag_cache"     # index files live here
     INDEX_NAME: str = "index_all-MiniLM-L6-v2"
 
-    # Device / dtype
-    DEVICE: str = "cuda" if torch.cuda.is_available() else "cpu"
-    DTYPE = (
-        torch.bfloat16 if (torch.cuda.is_available() and torch.cuda.is_bf16_supported())
-        else (torch.float16 if torch.cuda.is_available() else torch.float32)
-    )
+    # Tenants: each --build publishes its bundle under a name (CACHE_DIR/refs/<tenant>.json).
+    # Questions search the BASE_TENANT corpus plus the asking user's own overlay, if they have one.
+    BASE_TENANT: str = "base"
+    USER_DATA_DIR: str = "./user_pdfs"         # --build --tenant <user> reads USER_DATA_DIR/<user>/*.pdf
+    SHARD_POOL_MAX_BYTES: int = 1 << 30        # loaded user overlays beyond this are evicted, LRU first
+    SHARD_POOL_MAX_SHARDS: int = 512
+    SHARD_GC_GRACE_S: float = 6 * 3600.0       # unreferenced shards are only dropped once untouched this long
+
+    # Device / dtype: None = "cuda" when available, else "cpu" (resolved on first use, importing torch)
+    DEVICE_PREF: Optional[str] = None
+
+    @property
+    def DEVICE(self) -> str:
+        return self.DEVICE_PREF or ("cuda" if _cuda_available() else "cpu")
+
+    @property
+    def DTYPE(self):
+        if self.DEVICE != "cuda":
+            return torch.float32
+        return torch.bfloat16 if torch.cuda.is_bf16_supported() else torch.float16
+
+    # CPU inference for the LM (ignored on CUDA), comma-separated: "float32" (as loaded), "int8"
+    # (dynamic int8 quantisation of the Linear layers), "compile" (torch.compile), e.g. "int8,compile".
+    # Compare them on your hardware with --bench-lm.
+    LM_BACKEND: str = "float32"
+    TORCH_THREADS: Optional[int] = None  # intra-op threads; None = auto (all usable cores)
 
     # Speed profile - optimized for <10 second responses
     FAST_MODE: bool = True
@@ -84,12 +146,60 @@ class Config:
     CHUNK_OVERLAP_TOKENS: int = 32     # reduced overlap
     LIMIT_PAGES: Optional[int] = None  # e.g., 30 for quick pilot builds
 
+    # Index storage: vectors as "float32" or "float16" (half the RSS / page cache, small recall cost)
+    INDEX_VEC_DTYPE: str = "float32"
+    # Search-time scan over compact codes: "none", "int8" (per-vector scale, 4x smaller) or "pq"
+    # (product quantisation, PQ_M bytes/vector). The bundle vectors stay on disk for the re-rank.
+    INDEX_QUANTIZATION: str = "none"
+    PQ_M: int = 48                     # PQ sub-vectors; must divide the embedding dim (384)
+    QUANT_RERANK_CANDIDATES: int = 100 # re-score this many quantized hits exactly (0 = off)
+
+    # Build-time dedup: chunks whose text repeats (exactly, or MinHash-estimated Jaccard similarity
+    # of word 5-shingles >= DEDUP_JACCARD) are stored once; the other occurrences become provenance
+    DEDUP: bool = True
+    DEDUP_JACCARD: float = 0.8
+
     # Retrieval - optimized for speed
     TOP_K: int = 3                     # slightly more context
     CONFIDENCE_THRESHOLD: float = 0.2  # lower threshold for more responses
 
+    # Vector index behind search(): "exact" (argpartition), "ivf" (k-means buckets, approximate)
+    # or "auto" (ivf once the corpus reaches IVF_MIN_CHUNKS)
+    INDEX_BACKEND: str = "auto"
+    IVF_MIN_CHUNKS: int = 20000
+    IVF_NLIST: Optional[int] = None    # None = ~4*sqrt(N) buckets
+    IVF_NPROBE: int = 8                # buckets scanned per query; higher = better recall, slower
+    IVF_TRAIN_ITERS: int = 10
+
+    # Query-time diversification: MMR over MMR_CANDIDATES so the TOP_K chunks cover distinct content.
+    # MMR_LAMBDA weighs relevance against similarity to chunks already picked (1.0 = off).
+    MMR_LAMBDA: float = 0.5
+    MMR_CANDIDATES: int = 12
+
+    # Cross-encoder re-ranking: retrieve RERANK_CANDIDATES, re-score each (question, chunk) pair with a
+    # small cross-encoder and keep the best TOP_K. Past RERANK_BUDGET_MS the bi-encoder order is kept.
+    RERANK: bool = False
+    RERANK_MODEL: str = "cross-encoder/ms-marco-MiniLM-L-6-v2"
+    RERANK_CANDIDATES: int = 20
+    RERANK_BATCH_SIZE: int = 16
+    RERANK_BUDGET_MS: float = 150.0
+    RERANK_CACHE_SIZE: int = 16384     # (query, chunk) -> score
+    RERANK_CACHE_TTL_S: float = 6 * 3600.0
+
+    # Hybrid retrieval: BM25 over an inverted index (exact terms like "Roth", "401k", "APR")
+    # fused with dense similarity. "off", "rrf" (reciprocal rank fusion) or "weighted".
+    HYBRID_SEARCH: str = "rrf"
+    HYBRID_CANDIDATES: int = 50        # per-retriever candidates fed into fusion
+    RRF_K: int = 60
+    HYBRID_DENSE_WEIGHT: float = 0.7   # "weighted": dense cosine vs max-normalised BM25
+    BM25_K1: float = 1.2
+    BM25_B: float = 0.75
+    BM25_MAX_POSTINGS: int = 2000      # per query term, highest-impact postings first (pruning)
+    BM25_BUILD_BLOCK: int = 1 << 20    # postings held in memory at a time while building
+
     # Context / decoding - optimized for speed
-    MAX_CONTEXT_TOKENS: int = 512      # very small context window
+    MAX_CONTEXT_TOKENS: int = 512      # very small context window (whole prompt, not just the context)
+    PRETOKENIZE_CHUNKS: bool = True    # store chunk LM token ids in the bundle at build time
     MAX_NEW_TOKENS: int = 80           # increased for better responses
     TEMPERATURE: float = 0.1            # very low for speed
     TOP_P: float = 0.7                 # lower for speed
@@ -97,7 +207,46 @@ class Config:
 
     # IO / parsing
     USE_PYMUPDF: bool = True
-    N_WORKERS: int = max(1, (os.cpu_count() or 1))
+    N_WORKERS: int = max(1, (os.cpu_count() or 1))  # extraction/chunking processes for --build
+    PAGES_PER_TASK: int = 8            # page-range granularity of the extraction pool
+
+    # Generation batching: concurrent answer() calls are coalesced into one generate()
+    GEN_BATCHING: bool = True
+    GEN_MAX_BATCH: int = 8             # max prompts per generate call
+    GEN_BATCH_WAIT_MS: float = 10.0    # how long the first request waits for company
+    PREFIX_KV_CACHE: bool = True       # reuse per-domain system-prompt KV states (single-sequence generate)
+
+    # Caches: L1 normalised query -> (embedding, hits), L2 (bundle, model, prompt) -> answer.
+    # Keys carry the bundle id, so loading a different index invalidates everything automatically.
+    CACHE_ENABLED: bool = True
+    QUERY_CACHE_SIZE: int = 4096
+    QUERY_CACHE_TTL_S: float = 3600.0
+    ANSWER_CACHE_SIZE: int = 1024
+    ANSWER_CACHE_TTL_S: float = 6 * 3600.0
+    CACHE_PERSIST_PATH: Optional[str] = None  # e.g. "./rag_cache/qa_cache.pkl" to survive restarts
+
+    # Semantic answer cache: reuse a stored answer when a new question embeds within
+    # SEMANTIC_CACHE_THRESHOLD (cosine) of an answered one AND retrieves the same chunks
+    SEMANTIC_CACHE: bool = True
+    SEMANTIC_CACHE_SIZE: int = 2048
+    SEMANTIC_CACHE_THRESHOLD: float = 0.92
+    SEMANTIC_CACHE_TTL_S: float = 6 * 3600.0
+    USE_KEYWORD_TEMPLATES: bool = False  # legacy hard-coded answers, superseded by the semantic cache
+
+    # Serving (--serve)
+    SERVE_HOST: str = "127.0.0.1"
+    SERVE_PORT: int = 8765
+
+    # Concurrency (async API and --serve): questions in flight beyond MAX_PENDING_REQUESTS are
+    # refused at once (Overloaded / HTTP 429) instead of queueing without bound
+    MAX_PENDING_REQUESTS: int = 32
+    REQUEST_TIMEOUT_S: float = 30.0    # per-question deadline; generation stops when it passes (0 = none)
+    RETRIEVE_WORKERS: int = 4          # async API threads for embedding, search and prompt packing
+
+    # Telemetry sinks, comma-separated: "log" (JSON span lines), "prometheus" (GET /metrics); "" = off.
+    # In-process callbacks: telemetry.add_sink(fn).
+    TELEMETRY: str = ""
+    TELEMETRY_LOG_PATH: Optional[str] = None  # None = stderr
 
 config = Config()
 
@@ -108,6 +257,34 @@ FALLBACK_MODELS = [
 ]
 
 # ---------------- Torch setup ----------------
+@lru_cache(maxsize=1)
+def _cuda_available() -> bool:
+    return torch.cuda.is_available()
+
+# Cores this process may actually use: affinity mask and cgroup CPU quota, capped at torch's own
+# default (physical cores, or OMP_NUM_THREADS)
+def usable_cores() -> int:
+    try:
+        cores = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cores = os.cpu_count() or 1
+    try:
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            quota, period = f.read().split()
+        if quota != "max":
+            cores = min(cores, max(1, int(quota) // int(period)))
+    except (OSError, ValueError):
+        pass
+    return max(1, min(cores, torch.get_num_threads()))
+
+# Intra-op threads per generate(): every usable core. Unbatched and streaming generate() calls
+# hold the LM lock, so one of them decodes at a time; with GEN_BATCHING a streaming request can
+# decode alongside the scheduler, but the chat route never streams, so the main decode isn't
+# starved for that case. Servers that do stream heavily can split cores via TORCH_THREADS.
+def auto_threads() -> int:
+    return usable_cores()
+
+# Runs once, when torch is first imported
 def setup_torch():
     torch.set_grad_enabled(False)
     if config.DEVICE == "cuda":
@@ -120,10 +297,194 @@ def setup_torch():
         torch.cuda.empty_cache()
     else:
         try:
-            torch.set_num_threads(2)
+            torch.set_num_threads(config.TORCH_THREADS or auto_threads())
         except Exception:
             pass
-    print(f"Using device: {config.DEVICE}, dtype: {config.DTYPE}")
+    print(f"Using device: {config.DEVICE}, dtype: {config.DTYPE}, threads: {torch.get_num_threads()}")
+
+# ---------------- Telemetry ----------------
+# Timing spans and metrics for answer/build stages. Spans nest per thread and share a trace id;
+# each finished span goes to every sink (JSON log lines, in-process callbacks) and into the
+# metrics registry (histograms/counters, gauges pulled from collectors at scrape time), which
+# GET /metrics renders in Prometheus text format. With no sink configured, span() hands back a
+# shared no-op object and observe() returns immediately.
+class MetricsRegistry:
+    MS_BUCKETS = (1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000, 60000)
+    TOKEN_BUCKETS = (16, 32, 64, 128, 256, 512, 1024, 2048, 4096, 8192)
+    RATE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._hists = {}     # (name, labels) -> [buckets, counts per bucket (+Inf last), sum]
+        self._counters = {}  # (name, labels) -> value
+        self.collectors = []  # () -> iterable of (name, {label: value}, gauge value)
+
+    def observe(self, name: str, value: float, buckets=MS_BUCKETS, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            h = self._hists.get(key)
+            if h is None:
+                h = self._hists[key] = [buckets, [0] * (len(buckets) + 1), 0.0]
+            i = next((n for n, b in enumerate(h[0]) if value <= b), len(h[0]))
+            h[1][i] += 1
+            h[2] += value
+
+    def inc(self, name: str, n: float = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + n
+
+    def add_collector(self, fn):
+        self.collectors.append(fn)
+
+    @staticmethod
+    def _labels(labels, extra=()) -> str:
+        items = list(labels) + list(extra)
+        if not items:
+            return ""
+        esc = lambda v: str(v).replace("\\", "\\\\").replace('"', '\\"')
+        return "{" + ",".join(f'{k}="{esc(v)}"' for k, v in items) + "}"
+
+    def render(self) -> str:
+        lines, typed = [], set()
+        def typ(name, kind):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} {kind}")
+        with self._lock:
+            hists = {k: (h[0], list(h[1]), h[2]) for k, h in self._hists.items()}
+            counters = dict(self._counters)
+        for (name, labels), (buckets, counts, total) in sorted(hists.items()):
+            typ(name, "histogram")
+            acc = 0
+            for b, c in zip(list(buckets) + ["+Inf"], counts):
+                acc += c
+                lines.append(f"{name}_bucket{self._labels(labels, [('le', b)])} {acc}")
+            lines.append(f"{name}_sum{self._labels(labels)} {total}")
+            lines.append(f"{name}_count{self._labels(labels)} {acc}")
+        for (name, labels), v in sorted(counters.items()):
+            typ(name, "counter")
+            lines.append(f"{name}{self._labels(labels)} {v}")
+        gauges = {}  # samples of one metric must be contiguous
+        for fn in self.collectors:
+            try:
+                for name, labels, v in fn():
+                    gauges.setdefault(name, []).append(f"{name}{self._labels(sorted(labels.items()))} {v}")
+            except Exception as e:
+                lines.append(f"# collector error: {e}")
+        for name, samples in gauges.items():
+            typ(name, "gauge")
+            lines.extend(samples)
+        return "\n".join(lines) + "\n"
+
+class JSONLogSink:
+    def __init__(self, path: Optional[str] = None):
+        self.fh = open(path, "a", buffering=1) if path else sys.stderr
+        self._lock = threading.Lock()
+
+    def __call__(self, event: dict):
+        line = json.dumps(event, default=str)
+        with self._lock:
+            self.fh.write(line + "\n")
+
+class _NoopSpan:
+    __slots__ = ()
+    def __enter__(self): return self
+    def __exit__(self, *exc): return False
+    def set(self, **attrs): pass
+
+_NOOP_SPAN = _NoopSpan()
+
+class _Span:
+    __slots__ = ("tel", "name", "attrs", "timings", "key", "t0", "trace", "parent")
+
+    def __init__(self, tel, name: str, attrs: dict, timings: Optional[dict], key: Optional[str]):
+        self.tel, self.name, self.attrs, self.timings, self.key = tel, name, attrs, timings, key
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def __enter__(self):
+        if self.tel.enabled:
+            stack = self.tel._stack()
+            self.parent = stack[-1] if stack else None
+            self.trace = self.parent.trace if self.parent else os.urandom(8).hex()
+            stack.append(self)
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        ms = (time.perf_counter() - self.t0) * 1000
+        if self.timings is not None:
+            self.timings[self.key] = ms
+        if self.tel.enabled:
+            self.tel._stack().pop()
+            if exc_type is GeneratorExit:
+                self.attrs["cancelled"] = True  # streaming consumer went away
+            elif exc_type is not None:
+                self.attrs["error"] = exc_type.__name__
+            self.tel._finish(self.name, ms, self.trace, self.parent.name if self.parent else None, self.attrs)
+        return False
+
+class Telemetry:
+    def __init__(self):
+        self.enabled = False
+        self.sinks = []  # callables taking one span event dict
+        self.metrics = MetricsRegistry()
+        self.prometheus = False
+        self._local = threading.local()
+
+    # spec: comma-separated sink names, "log" and/or "prometheus" ("" = off)
+    def configure(self, spec: str, log_path: Optional[str] = None):
+        for name in (s.strip() for s in (spec or "").split(",")):
+            if name == "log":
+                self.add_sink(JSONLogSink(log_path))
+            elif name == "prometheus":
+                self.prometheus = self.enabled = True
+            elif name:
+                raise ValueError(f"Unknown telemetry sink: {name}")
+
+    def add_sink(self, sink):
+        self.sinks.append(sink)
+        self.enabled = True
+
+    def _stack(self) -> list:
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    # `timings`/`key`: also store the duration there (ms), which works with telemetry off
+    def span(self, name: str, timings: Optional[dict] = None, key: Optional[str] = None, **attrs):
+        if not self.enabled and timings is None:
+            return _NOOP_SPAN
+        return _Span(self, name, attrs, timings, key or f"{name}_ms")
+
+    # A duration measured elsewhere (scheduler batches, build worker time)
+    def record(self, name: str, ms: float, **attrs):
+        if self.enabled:
+            stack = self._stack()
+            parent = stack[-1] if stack else None
+            self._finish(name, ms, parent.trace if parent else os.urandom(8).hex(), parent.name if parent else None, attrs)
+
+    def observe(self, name: str, value: float, buckets=MetricsRegistry.MS_BUCKETS, **labels):
+        if self.enabled:
+            self.metrics.observe(name, value, buckets, **labels)
+
+    def _finish(self, name: str, ms: float, trace: str, parent: Optional[str], attrs: dict):
+        self.metrics.observe("rag_span_ms", ms, span=name)
+        if attrs.get("error"):
+            self.metrics.inc("rag_span_errors_total", span=name)
+        if self.sinks:
+            event = {"ts": round(time.time(), 3), "trace": trace, "span": name, "parent": parent,
+                     "ms": round(ms, 3), **attrs}
+            for sink in self.sinks:
+                try:
+                    sink(event)
+                except Exception:
+                    pass
+
+telemetry = Telemetry()
 
 # ---------------- Text utils ----------------
 class SimpleTextProcessor:
@@ -174,9 +535,9 @@ def create_chunks(text: str, max_tokens: int, overlap: int) -> List[str]:
 # ---------------- Embeddings ----------------
 class STEmbedder:
     def __init__(self, name="sentence-transformers/all-MiniLM-L6-v2", device=None):
+        self.device = device or config.DEVICE  # first: resolving the device imports (and sets up) torch
         print(f"Loading SentenceTransformer: {name}")
-        self.model = SentenceTransformer(name)
-        self.device = device or ("cuda" if torch.cuda.is_available() else "cpu")
+        self.model = _import("sentence_transformers").SentenceTransformer(name)
         try:
             self.model = self.model.to(self.device)
         except Exception:
@@ -195,20 +556,427 @@ class STEmbedder:
     def embed_text(self, t: str) -> np.ndarray:
         return self.embed_texts([t])[0]
 
+# ---------------- Cross-encoder re-ranking ----------------
+# Scores each (query, chunk) pair jointly: much sharper than the bi-encoder cosine, and affordable on
+# a small candidate pool. Pair scores are cached, so a repeated or near-repeated question only scores
+# the chunks it has not seen. Batches run until the next one would overshoot the budget; then the
+# caller keeps bi-encoder order (the scores computed so far stay cached for next time).
+class CrossEncoderReranker:
+    def __init__(self, name: str, device=None):
+        self.device = device or config.DEVICE
+        print(f"Loading CrossEncoder: {name}")
+        self.model = _import("sentence_transformers").CrossEncoder(name, device=self.device, max_length=512)
+        self.cache = LRUCache("rerank", config.RERANK_CACHE_SIZE, config.RERANK_CACHE_TTL_S)
+        self.model.predict([("warm up", "warm up")], show_progress_bar=False)  # first-call overhead off the budget
+        self.batch_ms = 0.0  # moving average of one batch, to predict the next
+        self.runs = self.fallbacks = 0
+
+    # keys: a stable id per text (e.g. (bundle_id, row)); -> indices best first, or None over budget
+    def rank(self, query: str, texts: List[str], keys: list, batch_size: int, budget_ms: float) -> Optional[List[int]]:
+        t0 = time.perf_counter()
+        nq = normalize_query(query)
+        self.runs += 1
+        scores = [self.cache.get((nq, k)) for k in keys]
+        todo = [i for i, sc in enumerate(scores) if sc is None]
+        for b in range(0, len(todo), batch_size):
+            if (time.perf_counter() - t0) * 1000 + self.batch_ms > budget_ms:
+                self.fallbacks += 1
+                return None
+            t1 = time.perf_counter()
+            batch = todo[b:b + batch_size]
+            out = self.model.predict([(query, texts[i]) for i in batch], batch_size=batch_size,
+                                     show_progress_bar=False)
+            for i, sc in zip(batch, out):
+                scores[i] = float(sc)
+                self.cache.put((nq, keys[i]), scores[i])
+            ms = (time.perf_counter() - t1) * 1000
+            self.batch_ms = ms if not self.batch_ms else 0.8 * self.batch_ms + 0.2 * ms
+        return sorted(range(len(texts)), key=lambda i: -scores[i])
+
+    def stats(self) -> dict:
+        return {"runs": self.runs, "fallbacks": self.fallbacks, "batch_ms": round(self.batch_ms, 2),
+                "cache": self.cache.stats()}
+
 # ---------------- Retrieval helpers ----------------
 class Document:
-    __slots__ = ("text","page","chunk_id","source")
-    def __init__(self, text: str, page: int, chunk_id: int, source: str):
+    __slots__ = ("text","page","chunk_id","source","row","shard","also")
+    def __init__(self, text: str, page: int, chunk_id: int, source: str, row: int = -1):
         self.text = text
         self.page = page
         self.chunk_id = chunk_id
         self.source = source
+        self.row = row  # position in the loaded index (-1 = not from an index)
+        self.shard = None  # IndexShard the row belongs to, set on retrieval
+        self.also = ()  # (source, page, chunk_id) of duplicates folded into this chunk at build time
+
+# dv may be a float16 memmap: upcast block-wise so no full float32 copy is ever materialised
+def _dot(dv: np.ndarray, qv: np.ndarray, block: int = 1 << 16) -> np.ndarray:
+    if dv.dtype == np.float32:
+        return dv @ qv
+    out = np.empty(len(dv), dtype=np.float32)
+    for i in range(0, len(dv), block):
+        out[i:i + block] = dv[i:i + block].astype(np.float32) @ qv
+    return out
 
-def top_k_sim(qv: np.ndarray, dv: np.ndarray, k: int):
-    sims = dv @ qv
-    idx = np.argsort(-sims)[:k]
+def _top_k(sims: np.ndarray, k: int):
+    k = min(k, len(sims))
+    if k <= 0:
+        return []
+    idx = np.argpartition(-sims, k - 1)[:k]   # O(N) selection, then sort only the k winners
+    idx = idx[np.argsort(-sims[idx])]
     return [(int(i), float(sims[i])) for i in idx]
 
+def top_k_sim(qv: np.ndarray, dv: np.ndarray, k: int):
+    return _top_k(_dot(dv, qv), k)
+
+# ---------------- Quantized vectors ----------------
+# Vector stores expose scores(qv, rows=None) -> float32 similarities; the index backends only
+# ever scan through them. int8 / pq keep the float32 (or float16) bundle vectors on disk for the
+# exact re-rank, but the scan touches only the codes (4x / 32x fewer bytes for 384 dims).
+class DenseVectors:
+    kind = "dense"
+
+    def __init__(self, vecs: np.ndarray):
+        self.vecs = vecs
+
+    def __len__(self):
+        return len(self.vecs)
+
+    def scores(self, qv: np.ndarray, rows: Optional[np.ndarray] = None) -> np.ndarray:
+        return _dot(self.vecs if rows is None else self.vecs[rows], qv)
+
+# int8 with one float32 scale per vector: x ~= codes * scale, scale = max|x| / 127
+class Int8Vectors:
+    kind = "int8"
+
+    def __init__(self, codes: np.ndarray, scales: np.ndarray):
+        self.codes = codes
+        self.scales = scales
+
+    def __len__(self):
+        return len(self.codes)
+
+    @classmethod
+    def encode(cls, vecs: np.ndarray, block: int = 1 << 14):
+        codes = np.empty(vecs.shape, dtype=np.int8)
+        scales = np.empty(len(vecs), dtype=np.float32)
+        for i in range(0, len(vecs), block):
+            x = np.asarray(vecs[i:i + block], dtype=np.float32)
+            s = np.maximum(np.abs(x).max(axis=1), 1e-12) / 127.0
+            codes[i:i + block] = np.rint(x / s[:, None]).astype(np.int8)
+            scales[i:i + block] = s
+        return cls(codes, scales)
+
+    def scores(self, qv: np.ndarray, rows: Optional[np.ndarray] = None, block: int = 1 << 14) -> np.ndarray:
+        codes = self.codes if rows is None else self.codes[rows]
+        scales = self.scales if rows is None else self.scales[rows]
+        out = np.empty(len(codes), dtype=np.float32)
+        for i in range(0, len(codes), block):
+            out[i:i + block] = codes[i:i + block].astype(np.float32) @ qv
+        return out * scales
+
+    def save(self, prefix: str):
+        np.save(prefix + "_codes.npy", self.codes)
+        np.save(prefix + "_scales.npy", self.scales)
+
+    @classmethod
+    def load(cls, prefix: str):
+        return cls(np.load(prefix + "_codes.npy", mmap_mode="r"), np.load(prefix + "_scales.npy", mmap_mode="r"))
+
+# Product quantisation: dim split into m sub-vectors, each replaced by the id of its nearest of
+# 256 centroids (m bytes per vector). Queries score by asymmetric distance: one (m, 256) table of
+# sub-query . centroid, then a gather-and-sum per vector.
+class PQVectors:
+    kind = "pq"
+
+    def __init__(self, codebooks: np.ndarray, codes: np.ndarray):
+        self.codebooks = codebooks  # (m, 256, dim // m)
+        self.codes = codes          # (n, m) uint8
+
+    def __len__(self):
+        return len(self.codes)
+
+    @staticmethod
+    def _nearest(x: np.ndarray, cb: np.ndarray) -> np.ndarray:
+        return np.argmin((cb * cb).sum(axis=1)[None, :] - 2.0 * (x @ cb.T), axis=1)
+
+    @classmethod
+    def train(cls, vecs: np.ndarray, m: int = 48, iters: int = 12, max_train: int = 256 * 64, seed: int = 0):
+        dim = vecs.shape[1]
+        if dim % m:
+            raise ValueError(f"PQ_M={m} must divide the embedding dim {dim}")
+        rng = np.random.default_rng(seed)
+        train = vecs if len(vecs) <= max_train else vecs[np.sort(rng.choice(len(vecs), max_train, replace=False))]
+        train = np.asarray(train, dtype=np.float32)
+        ksub, dsub = min(256, len(train)), dim // m
+        codebooks = np.zeros((m, 256, dsub), dtype=np.float32)
+        for j in range(m):
+            x = train[:, j * dsub:(j + 1) * dsub]
+            cb = x[rng.choice(len(x), ksub, replace=False)].copy()
+            for _ in range(iters):  # plain Lloyd's k-means per subspace
+                assign = cls._nearest(x, cb)
+                counts = np.bincount(assign, minlength=ksub)
+                sums = np.stack([np.bincount(assign, weights=x[:, d], minlength=ksub) for d in range(dsub)], axis=1)
+                nonempty = counts > 0
+                cb[nonempty] = sums[nonempty] / counts[nonempty, None]
+            codebooks[j, :ksub] = cb
+            codebooks[j, ksub:] = cb[0]  # tiny corpora: pad unused code slots
+        return cls(codebooks, np.empty((0, m), dtype=np.uint8))
+
+    def encode(self, vecs: np.ndarray, block: int = 1 << 14):
+        m, _, dsub = self.codebooks.shape
+        codes = np.empty((len(vecs), m), dtype=np.uint8)
+        for i in range(0, len(vecs), block):
+            x = np.asarray(vecs[i:i + block], dtype=np.float32)
+            for j in range(m):
+                codes[i:i + block, j] = self._nearest(x[:, j * dsub:(j + 1) * dsub], self.codebooks[j])
+        self.codes = codes
+        return self
+
+    def scores(self, qv: np.ndarray, rows: Optional[np.ndarray] = None, block: int = 1 << 16) -> np.ndarray:
+        m, _, dsub = self.codebooks.shape
+        table = np.einsum("jcd,jd->jc", self.codebooks, qv.reshape(m, dsub)).astype(np.float32)
+        codes = self.codes if rows is None else self.codes[rows]
+        out = np.zeros(len(codes), dtype=np.float32)
+        for i in range(0, len(codes), block):
+            c = np.asarray(codes[i:i + block])
+            acc = out[i:i + block]
+            for j in range(m):
+                acc += table[j][c[:, j]]
+        return out
+
+    def save(self, prefix: str):
+        np.save(prefix + "_codebooks.npy", self.codebooks)
+        np.save(prefix + "_codes.npy", self.codes)
+
+    @classmethod
+    def load(cls, prefix: str):
+        return cls(np.load(prefix + "_codebooks.npy"), np.load(prefix + "_codes.npy", mmap_mode="r"))
+
+def _sidecar_prefix(bundle_path: str, kind: str) -> str:
+    if os.path.isdir(bundle_path):
+        return os.path.join(bundle_path, kind)
+    return os.path.splitext(bundle_path)[0] + f".{kind}"  # legacy single-file bundle
+
+# Quantized codes are derived from the bundle vectors, so they live in sidecars (built on first
+# load, like the IVF lists) and never change the bundle id.
+def load_vector_store(vecs: np.ndarray, bundle_path: Optional[str], quant: Optional[str] = None):
+    quant = quant or config.INDEX_QUANTIZATION
+    if quant == "none":
+        return DenseVectors(vecs)
+    if quant not in ("int8", "pq"):
+        raise ValueError(f"Unknown INDEX_QUANTIZATION: {quant}")
+    cls = Int8Vectors if quant == "int8" else PQVectors
+    prefix = _sidecar_prefix(bundle_path, f"{quant}{config.PQ_M}" if quant == "pq" else quant) if bundle_path else None
+    if prefix and os.path.exists(prefix + "_codes.npy"):
+        try:
+            store = cls.load(prefix)
+            if len(store) == len(vecs):
+                return store
+            print(f"⚠️ Rebuilding {quant} codes ({len(store)} codes for {len(vecs)} vectors)")
+        except Exception as e:
+            print(f"⚠️ Rebuilding {quant} codes ({e})")
+    t0 = time.time()
+    if quant == "int8":
+        store = Int8Vectors.encode(vecs)
+    else:
+        store = PQVectors.train(vecs, config.PQ_M).encode(vecs)
+    print(f"🗜️ {quant} codes for {len(vecs)} vectors in {time.time()-t0:.1f}s")
+    if prefix:
+        store.save(prefix)
+    return store
+
+# ---------------- Vector index ----------------
+# Pluggable backends behind SimplePDFRAG.search. All of them take L2-normalised vectors and
+# return [(row, cosine)] best-first, like top_k_sim. Scoring goes through a vector store.
+class ExactIndex:
+    kind = "exact"
+
+    def __init__(self, store):
+        self.store = store
+
+    def search(self, qv: np.ndarray, k: int):
+        return _top_k(self.store.scores(qv), k)
+
+def _assign(x: np.ndarray, cent: np.ndarray, chunk: int = 65536) -> np.ndarray:
+    out = np.empty(len(x), dtype=np.int32)
+    for i in range(0, len(x), chunk):
+        out[i:i + chunk] = np.argmax(x[i:i + chunk] @ cent.T, axis=1)
+    return out
+
+def spherical_kmeans(x: np.ndarray, k: int, iters: int = 10, seed: int = 0, max_train: int = 256) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    train = x if len(x) <= k * max_train else x[np.sort(rng.choice(len(x), k * max_train, replace=False))]
+    train = np.asarray(train, dtype=np.float32)
+    cent = train[rng.choice(len(train), k, replace=False)].copy()
+    for _ in range(iters):
+        assign = _assign(train, cent)
+        order = np.argsort(assign, kind="stable")
+        counts = np.bincount(assign, minlength=k)
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+        nonempty = counts > 0
+        sums = np.zeros_like(cent)
+        sums[nonempty] = np.add.reduceat(train[order], starts[nonempty], axis=0)
+        # re-seed empty clusters from random training points
+        n_empty = int((~nonempty).sum())
+        if n_empty:
+            sums[~nonempty] = train[rng.choice(len(train), n_empty, replace=False)]
+        cent = sums / np.maximum(np.linalg.norm(sums, axis=1, keepdims=True), 1e-12)
+    return cent.astype("float32")
+
+# IVF: k-means buckets; a query scans only the `nprobe` closest buckets (recall/speed knob).
+class IVFIndex:
+    kind = "ivf"
+
+    def __init__(self, store, centroids: np.ndarray, offsets: np.ndarray, ids: np.ndarray, nprobe: int):
+        self.store = store
+        self.centroids = centroids
+        self.offsets = offsets      # bucket b holds ids[offsets[b]:offsets[b+1]]
+        self.ids = ids
+        self.nprobe = nprobe
+
+    @classmethod
+    def train(cls, vecs: np.ndarray, store, nlist: Optional[int] = None, nprobe: int = 8, iters: int = 10):
+        nlist = nlist or int(4 * np.sqrt(len(vecs)))
+        nlist = max(1, min(nlist, len(vecs)))
+        cent = spherical_kmeans(vecs, nlist, iters=iters)
+        assign = _assign(vecs, cent)
+        ids = np.argsort(assign, kind="stable").astype(np.int32)
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(assign, minlength=nlist))]).astype(np.int64)
+        return cls(store, cent, offsets, ids, nprobe)
+
+    def search(self, qv: np.ndarray, k: int):
+        nprobe = min(self.nprobe, len(self.centroids))
+        cs = self.centroids @ qv
+        probe = np.argpartition(-cs, nprobe - 1)[:nprobe]
+        cand = np.concatenate([self.ids[self.offsets[b]:self.offsets[b + 1]] for b in probe])
+        if len(cand) == 0:
+            return []
+        return [(int(cand[i]), s) for i, s in _top_k(self.store.scores(qv, cand), k)]
+
+    def save(self, path: str):
+        with open(path, "wb") as f:
+            np.savez(f, centroids=self.centroids, offsets=self.offsets, ids=self.ids, n=np.int64(len(self.store)))
+
+    @classmethod
+    def load(cls, path: str, store, nprobe: int):
+        arr = np.load(path)
+        if int(arr["n"]) != len(store):
+            raise ValueError(f"{os.path.basename(path)} was built for {int(arr['n'])} vectors, index has {len(store)}")
+        return cls(store, arr["centroids"], arr["offsets"], arr["ids"], nprobe)
+
+def _sidecar_path(bundle_path: str, kind: str) -> str:
+    if os.path.isdir(bundle_path):
+        return os.path.join(bundle_path, f"{kind}.npz")
+    return os.path.splitext(bundle_path)[0] + f".{kind}.npz"  # legacy single-file bundle
+
+# Quantized scans are approximate: pull a wider candidate set from the fast path and re-score
+# it against the full-precision bundle vectors (only those rows are paged in).
+class RerankedIndex:
+    def __init__(self, index, vecs: np.ndarray, candidates: int):
+        self.index = index
+        self.vecs = vecs
+        self.candidates = candidates
+        self.kind = f"{index.kind}+rerank"
+
+    def __getattr__(self, name):  # nprobe etc. pass through to the wrapped backend
+        return getattr(self.index, name)
+
+    def __setattr__(self, name, value):
+        if name == "nprobe":
+            setattr(self.index, name, value)
+        else:
+            super().__setattr__(name, value)
+
+    def search(self, qv: np.ndarray, k: int):
+        cand = np.array([i for i, _ in self.index.search(qv, max(k, self.candidates))], dtype=np.int64)
+        if len(cand) == 0:
+            return []
+        order = np.sort(cand)  # ascending rows = sequential reads from the memmap
+        return [(int(order[i]), s) for i, s in top_k_sim(qv, self.vecs[order], k)]
+
+def load_vector_index(vecs: np.ndarray, bundle_path: Optional[str], backend: Optional[str] = None,
+                      quant: Optional[str] = None, rerank: Optional[int] = None):
+    backend = backend or config.INDEX_BACKEND
+    store = load_vector_store(vecs, bundle_path, quant)
+    rerank = config.QUANT_RERANK_CANDIDATES if rerank is None else rerank
+    if backend == "auto":
+        backend = "ivf" if len(vecs) >= config.IVF_MIN_CHUNKS else "exact"
+    if backend == "exact":
+        index = ExactIndex(store)
+    elif backend != "ivf":
+        raise ValueError(f"Unknown INDEX_BACKEND: {backend}")
+    else:
+        index = _load_ivf(vecs, store, bundle_path)
+    if store.kind != "dense":
+        index.kind = f"{index.kind}/{store.kind}"
+        if rerank > 0:
+            index = RerankedIndex(index, vecs, rerank)
+    return index
+
+def _load_ivf(vecs: np.ndarray, store, bundle_path: Optional[str]):
+    path = _sidecar_path(bundle_path, "ivf") if bundle_path else None
+    if path and os.path.exists(path):
+        try:
+            return IVFIndex.load(path, store, config.IVF_NPROBE)
+        except Exception as e:
+            print(f"⚠️ Rebuilding IVF index ({e})")
+    t0 = time.time()
+    index = IVFIndex.train(vecs, store, config.IVF_NLIST, config.IVF_NPROBE, config.IVF_TRAIN_ITERS)
+    print(f"🧭 IVF index: {len(index.centroids)} lists over {len(vecs)} vectors in {time.time()-t0:.1f}s")
+    if path:
+        index.save(path)
+    return index
+
+# Recall@k / latency of the ANN backend and of the quantized stores against exact float32
+# search. Queries are perturbed copies of indexed vectors so the benchmark needs no embedder.
+def bench_vector_index(vecs: np.ndarray, bundle_path: Optional[str], n_queries: int = 200, k: int = 10,
+                       nprobes=(1, 2, 4, 8, 16, 32), quants=("float16", "int8", "pq"), seed: int = 0) -> dict:
+    rng = np.random.default_rng(seed)
+    qs = vecs[rng.choice(len(vecs), min(n_queries, len(vecs)), replace=False)]
+    qs = np.asarray(qs, dtype=np.float32) + rng.normal(scale=0.05, size=qs.shape).astype("float32")
+    qs /= np.linalg.norm(qs, axis=1, keepdims=True)
+
+    def run(index):
+        lat, res = [], []
+        for q in qs:
+            t0 = time.perf_counter()
+            res.append([i for i, _ in index.search(q, k)])
+            lat.append((time.perf_counter() - t0) * 1000)
+        lat = np.array(lat)
+        return res, {"mean_ms": round(float(lat.mean()), 4), "p95_ms": round(float(np.percentile(lat, 95)), 4)}
+
+    def recall(res):
+        return round(float(np.mean([len(set(a) & set(b)) / max(1, len(b)) for a, b in zip(res, truth)])), 4)
+
+    full = np.asarray(vecs, dtype=np.float32)
+    truth, exact = run(ExactIndex(DenseVectors(full)))
+    report = {"n_vectors": int(len(vecs)), "n_queries": int(len(qs)), "k": k, "exact": exact,
+              "quantized": [], "ivf": []}
+    for quant in quants:
+        if quant == "float16":
+            store = DenseVectors(full.astype(np.float16))
+            nbytes = store.vecs.nbytes
+        else:
+            store = load_vector_store(vecs, bundle_path, quant)
+            nbytes = store.codes.nbytes + getattr(store, "scales", np.empty(0)).nbytes
+        index = ExactIndex(store)
+        variants = [(quant, index)]
+        if quant != "float16" and config.QUANT_RERANK_CANDIDATES > 0:
+            variants.append((f"{quant}+rerank{config.QUANT_RERANK_CANDIDATES}",
+                             RerankedIndex(index, full, config.QUANT_RERANK_CANDIDATES)))
+        for name, idx in variants:
+            res, lat = run(idx)
+            report["quantized"].append({"store": name, "bytes_per_vector": round(nbytes / len(vecs), 1),
+                                        "recall": recall(res), **lat})
+    ivf = load_vector_index(vecs, bundle_path, backend="ivf")
+    for nprobe in nprobes:
+        ivf.nprobe = nprobe
+        res, lat = run(ivf)
+        report["ivf"].append({"nprobe": nprobe, "index": ivf.kind, "recall": recall(res), **lat})
+    ivf.nprobe = config.IVF_NPROBE
+    return report
+
 def _hash_file(path: str) -> str:
     h = hashlib.sha256()
     with open(path, "rb") as f:
@@ -218,14 +986,524 @@ def _hash_file(path: str) -> str:
             h.update(b)
     return h.hexdigest()
 
+# ---------------- Sparse (BM25) index ----------------
+_STOPWORDS = frozenset(
+    "a an and are as at be but by can do does for from has have how i if in is it its me my of on or "
+    "should so that the their then there this to was what when where which who why will with would you your".split()
+)
+
+def bm25_tokens(text: str) -> List[str]:
+    text = re.sub(r"(\w)\((\w)\)", r"\1\2", text.lower())  # "401(k)" -> "401k"
+    return [t for t in re.findall(r"[a-z0-9]+", text) if t not in _STOPWORDS]
+
+# Inverted index in CSR form: postings of vocab[t] are rows offsets[t]:offsets[t+1] of
+# (doc_ids, impacts), where impact is the doc's full BM25 contribution for that term. Postings
+# are sorted by impact, so pruning a long list is just reading its head.
+class BM25Index:
+    def __init__(self, vocab: np.ndarray, offsets: np.ndarray, doc_ids: np.ndarray, impacts: np.ndarray):
+        self.vocab = vocab          # sorted, looked up with searchsorted (no dict to build on load)
+        self.offsets = offsets
+        self.doc_ids = doc_ids
+        self.impacts = impacts
+
+    # Built a block of `block` postings at a time, so besides the vocabulary and one int per doc,
+    # memory doesn't grow with the corpus: (term, doc, tf) triples are spilled to raw files in
+    # work_dir (kept as compact arrays without one), scattered into term order in a second pass,
+    # then each run of terms is sorted by impact in place. The returned arrays are memmaps into
+    # work_dir; save() them before it goes away.
+    @classmethod
+    def build(cls, texts, k1: float = 1.2, b: float = 0.75, work_dir: Optional[str] = None, block: int = 1 << 20):
+        def alloc(name, dtype, n):
+            if work_dir is None:
+                return np.empty(n, dtype=dtype)
+            return np.memmap(os.path.join(work_dir, name), dtype=dtype, mode="w+", shape=(max(n, 1),))[:n]
+
+        term_idx, kept, lens, n_post = {}, [], [], 0  # kept/lens: appended by flush() only
+        files = [open(os.path.join(work_dir, f), "wb") for f in ("t.spill", "d.spill", "tf.spill")] if work_dir else None
+        buf_t, buf_d, buf_tf, buf_dl = [], [], [], []
+
+        def flush():
+            arrs = (np.array(buf_t, dtype=np.int32), np.array(buf_d, dtype=np.int32), np.array(buf_tf, dtype=np.int32))
+            if files:
+                for f, a in zip(files, arrs):
+                    f.write(a.tobytes())
+            else:
+                kept.append(arrs)
+            lens.append(np.array(buf_dl, dtype=np.float32))
+            for buf in (buf_t, buf_d, buf_tf, buf_dl):
+                buf.clear()
+
+        try:
+            for d, text in enumerate(texts):
+                toks = bm25_tokens(text)
+                buf_dl.append(len(toks))
+                for term, tf in Counter(toks).items():
+                    buf_t.append(term_idx.setdefault(term, len(term_idx)))
+                    buf_d.append(d)
+                    buf_tf.append(tf)
+                if len(buf_t) >= block:
+                    n_post += len(buf_t)
+                    flush()
+            n_post += len(buf_t)
+            flush()
+        finally:
+            for f in files or ():
+                f.close()
+        blocks = kept
+        if files and n_post:
+            spilled = [np.memmap(os.path.join(work_dir, f), dtype=np.int32, mode="r", shape=(n_post,))
+                       for f in ("t.spill", "d.spill", "tf.spill")]
+            blocks = [tuple(a[lo:lo + block] for a in spilled) for lo in range(0, n_post, block)]
+
+        dls = np.concatenate(lens)
+        n_docs, n_terms = len(dls), len(term_idx)
+        df = np.zeros(n_terms, dtype=np.int64)
+        for t, _, _ in blocks:
+            df += np.bincount(t, minlength=n_terms)
+        idf = np.log1p((n_docs - df.astype(np.float32) + 0.5) / (df.astype(np.float32) + 0.5))
+        avgdl = max(1e-9, float(dls.mean()) if n_docs else 1.0)
+
+        terms = np.array(list(term_idx), dtype=str)
+        del term_idx
+        vocab_order = np.argsort(terms)
+        rank = np.empty(n_terms, dtype=np.int64)
+        rank[vocab_order] = np.arange(n_terms)
+        offsets = np.concatenate([[0], np.cumsum(df[vocab_order])]).astype(np.int64)
+
+        # scatter: blocks arrive in doc order and are stably sorted by term, so each term's
+        # postings land in doc order
+        doc_ids, impacts = alloc("doc_ids.bin", np.int32, n_post), alloc("impacts.bin", np.float32, n_post)
+        cursor = offsets[:-1].copy()
+        for t, d, tf in blocks:
+            ts = rank[t]
+            tf = tf.astype(np.float32)
+            imp = (idf[t] * tf * (k1 + 1) / (tf + k1 * (1 - b + b * dls[d] / avgdl))).astype(np.float32)
+            order = np.argsort(ts, kind="stable")
+            ts = ts[order]
+            dest = cursor[ts] + (np.arange(len(ts)) - np.searchsorted(ts, ts))
+            doc_ids[dest], impacts[dest] = d[order], imp[order]
+            u, c = np.unique(ts, return_counts=True)
+            cursor[u] += c
+        del blocks
+        kept.clear()
+
+        # impact order within each term, a run of terms (about one block of postings) at a time
+        t0 = 0
+        while t0 < n_terms:
+            t1 = max(t0 + 1, int(np.searchsorted(offsets, offsets[t0] + block, side="right")) - 1)
+            t1 = min(t1, n_terms)
+            lo, hi = offsets[t0], offsets[t1]
+            labels = np.repeat(np.arange(t1 - t0), np.diff(offsets[t0:t1 + 1]))
+            order = np.lexsort((-impacts[lo:hi], labels))
+            doc_ids[lo:hi], impacts[lo:hi] = doc_ids[lo:hi][order], impacts[lo:hi][order]
+            t0 = t1
+        return cls(terms[vocab_order], offsets, doc_ids, impacts)
+
+    def search(self, query: str, k: int, max_postings: Optional[int] = None):
+        terms = np.unique(np.array(bm25_tokens(query), dtype=str))
+        if not len(terms) or not len(self.vocab):
+            return []
+        pos = np.minimum(np.searchsorted(self.vocab, terms), len(self.vocab) - 1)
+        ids, ws = [], []
+        for t in pos[self.vocab[pos] == terms]:
+            lo, hi = self.offsets[t], self.offsets[t + 1]
+            if max_postings:
+                hi = min(hi, lo + max_postings)
+            ids.append(self.doc_ids[lo:hi])
+            ws.append(self.impacts[lo:hi])
+        if not ids:
+            return []
+        docs, inv = np.unique(np.concatenate(ids), return_inverse=True)
+        scores = np.bincount(inv, weights=np.concatenate(ws))
+        k = min(k, len(docs))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(int(docs[i]), float(scores[i])) for i in top]
+
+    def save(self, path: str):
+        with open(path, "wb") as f:
+            np.savez(f, vocab=self.vocab, offsets=self.offsets, doc_ids=self.doc_ids, impacts=self.impacts)
+
+    @classmethod
+    def load(cls, path: str):
+        arr = np.load(path)
+        return cls(arr["vocab"], arr["offsets"], arr["doc_ids"], arr["impacts"])
+
+def load_bm25_index(documents, bundle_path: Optional[str]) -> BM25Index:
+    path = _sidecar_path(bundle_path, "bm25") if bundle_path else None
+    if path and os.path.exists(path):
+        return BM25Index.load(path)
+    t0 = time.time()
+    texts = (documents.text(i) for i in range(len(documents))) if hasattr(documents, "text") else (d.text for d in documents)
+    with tempfile.TemporaryDirectory(prefix="bm25-", dir=os.path.dirname(path) or None if path else None) as work_dir:
+        index = BM25Index.build(texts, config.BM25_K1, config.BM25_B, work_dir, config.BM25_BUILD_BLOCK)
+        print(f"🔤 BM25 index: {len(index.vocab)} terms, {len(index.doc_ids)} postings in {time.time()-t0:.1f}s")
+        if path:
+            index.save(path)
+            del index  # drop the memmaps before work_dir is removed
+            return BM25Index.load(path)
+        return BM25Index(index.vocab, index.offsets, np.array(index.doc_ids), np.array(index.impacts))
+
+# Fuse dense and sparse rankings ([(row, score)] best-first) into one list of rows
+def fuse_rankings(dense, sparse, k: int, mode: str = "rrf", rrf_k: int = 60, dense_weight: float = 0.7) -> List[int]:
+    fused = {}
+    if mode == "rrf":
+        for ranking in (dense, sparse):
+            for rank, (i, _) in enumerate(ranking):
+                fused[i] = fused.get(i, 0.0) + 1.0 / (rrf_k + rank + 1)
+    else:
+        top_sparse = sparse[0][1] if sparse else 1.0
+        for i, s in dense:
+            fused[i] = fused.get(i, 0.0) + dense_weight * s
+        for i, s in sparse:
+            fused[i] = fused.get(i, 0.0) + (1 - dense_weight) * s / max(top_sparse, 1e-9)
+    return sorted(fused, key=lambda i: -fused[i])[:k]
+
+# ---------------- Index bundle (memory-mapped) ----------------
+# A bundle is a directory CACHE_DIR/<bundle_id>/ of raw, append-only arrays:
+#   vecs.bin      N x dim vectors (float32 or float16), np.memmap-ed read-only
+#   texts.bin     UTF-8 chunk texts back to back; text_offsets.bin (int64, N+1) slices it
+#   pages.bin, cids.bin, src_ids.bin   int32 per chunk; src_ids index meta["sources"]
+#   dups.bin      int32 (row, src_id, page, cid) per duplicate folded into `row`, sorted by row (optional)
+#   meta.json     shapes/dtypes + build info; written last, so its presence marks a complete bundle
+# Nothing is unpickled or decompressed on load, and worker processes share the page cache.
+BUNDLE_FORMAT = "mmap-v1"
+
+class BundleWriter:
+    FILES = ("vecs", "texts", "text_offsets", "pages", "cids", "src_ids")
+
+    # resume=True picks up a checkpointed <out_dir>.tmp (files truncated back to the checkpoint)
+    def __init__(self, out_dir: str, vec_dtype: str = "float32", resume: bool = False):
+        self.out_dir = out_dir
+        self.tmp_dir = out_dir + ".tmp"
+        self.vec_dtype = np.dtype(vec_dtype)
+        self.state = self.read_checkpoint(out_dir) if resume else None
+        if self.state is None:
+            if os.path.isdir(self.tmp_dir):
+                shutil.rmtree(self.tmp_dir)
+            os.makedirs(self.tmp_dir)
+            self.files = {name: open(os.path.join(self.tmp_dir, f"{name}.bin"), "wb") for name in self.FILES}
+            self.files["text_offsets"].write(np.zeros(1, dtype=np.int64).tobytes())
+            self.sources: List[str] = []
+            self.n = 0
+            self.dim: Optional[int] = None
+            self._text_pos = 0
+            self.dups: List[Tuple[int, int, int, int]] = []
+            self.state = {}
+        else:
+            for name in self.FILES:
+                os.truncate(os.path.join(self.tmp_dir, f"{name}.bin"), self.state["sizes"][name])
+            self.files = {name: open(os.path.join(self.tmp_dir, f"{name}.bin"), "ab") for name in self.FILES}
+            self.sources = list(self.state["sources"])
+            self.n = self.state["n"]
+            self.dim = self.state["dim"]
+            self._text_pos = self.state["text_pos"]
+            self.dups = [tuple(d) for d in self.state.get("dups", [])]
+        self._src_idx = {src: i for i, src in enumerate(self.sources)}
+
+    @staticmethod
+    def read_checkpoint(out_dir: str) -> Optional[dict]:
+        try:
+            with open(os.path.join(out_dir + ".tmp", "progress.json")) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    # Durably records everything appended so far (+ caller state) as a resume point
+    def checkpoint(self, **extra):
+        for fh in self.files.values():
+            fh.flush()
+            os.fsync(fh.fileno())
+        state = dict(extra, n=self.n, dim=self.dim, text_pos=self._text_pos, sources=self.sources, dups=self.dups,
+                     sizes={name: fh.tell() for name, fh in self.files.items()})
+        tmp = os.path.join(self.tmp_dir, "progress.json.tmp")
+        with open(tmp, "w") as f:
+            json.dump(state, f)
+        os.replace(tmp, os.path.join(self.tmp_dir, "progress.json"))
+        self.state = state
+
+    def _src(self, source: str) -> int:
+        src = self._src_idx.setdefault(source, len(self.sources))
+        if src == len(self.sources):
+            self.sources.append(source)
+        return src
+
+    # Another occurrence of chunk `row` (which may still be in the caller's pending block)
+    def add_duplicate(self, row: int, source: str, page: int, cid: int):
+        self.dups.append((int(row), self._src(source), int(page), int(cid)))
+
+    def append(self, vecs: np.ndarray, texts: List[str], source: str, pages: np.ndarray, cids: np.ndarray):
+        if not len(texts):
+            return
+        if self.dim is None:
+            self.dim = int(vecs.shape[1])
+        src = self._src(source)
+        blobs = [t.encode("utf-8", errors="replace") for t in texts]
+        ends = self._text_pos + np.cumsum([len(b) for b in blobs], dtype=np.int64)
+        self._text_pos = int(ends[-1])
+        f = self.files
+        f["vecs"].write(np.ascontiguousarray(vecs, dtype=self.vec_dtype).tobytes())
+        f["texts"].write(b"".join(blobs))
+        f["text_offsets"].write(ends.tobytes())
+        f["pages"].write(np.asarray(pages, dtype=np.int32).tobytes())
+        f["cids"].write(np.asarray(cids, dtype=np.int32).tobytes())
+        f["src_ids"].write(np.full(len(texts), src, dtype=np.int32).tobytes())
+        self.n += len(texts)
+
+    def close(self, meta: dict) -> str:
+        for fh in self.files.values():
+            fh.close()
+        if self.dups:
+            np.array(sorted(self.dups), dtype=np.int32).tofile(os.path.join(self.tmp_dir, "dups.bin"))
+        meta = dict(meta, format=BUNDLE_FORMAT, n_chunks=self.n, dim=self.dim or 0,
+                    vec_dtype=self.vec_dtype.name, sources=self.sources, n_dups=len(self.dups))
+        with open(os.path.join(self.tmp_dir, "meta.json"), "w") as fh:
+            json.dump(meta, fh, indent=2)
+        if os.path.exists(os.path.join(self.tmp_dir, "progress.json")):
+            os.remove(os.path.join(self.tmp_dir, "progress.json"))
+        if os.path.isdir(self.out_dir):
+            shutil.rmtree(self.out_dir)
+        os.replace(self.tmp_dir, self.out_dir)
+        return self.out_dir
+
+def _map(path: str, dtype, shape=None):
+    if os.path.getsize(path) == 0:
+        return np.zeros(shape or (0,), dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode="r", shape=shape)
+
+# Random-access view over a bundle's chunks: a Document is only built for the rows asked for
+class ChunkStore:
+    def __init__(self, bundle_dir: str, meta: dict):
+        path = lambda name: os.path.join(bundle_dir, f"{name}.bin")
+        self.sources = meta["sources"]
+        self.blob = _map(path("texts"), np.uint8)
+        self.offsets = _map(path("text_offsets"), np.int64)
+        self.pages = _map(path("pages"), np.int32)
+        self.cids = _map(path("cids"), np.int32)
+        self.src_ids = _map(path("src_ids"), np.int32)
+        n_dups = meta.get("n_dups", 0)
+        self.dups = _map(path("dups"), np.int32, (n_dups, 4)) if n_dups else np.zeros((0, 4), dtype=np.int32)
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def text(self, i: int) -> str:
+        return bytes(self.blob[self.offsets[i]:self.offsets[i + 1]]).decode("utf-8", errors="replace")
+
+    def __getitem__(self, i: int) -> Document:
+        i = int(i)
+        d = Document(text=self.text(i), page=int(self.pages[i]), chunk_id=int(self.cids[i]),
+                     source=self.sources[int(self.src_ids[i])], row=i)
+        if len(self.dups):
+            lo, hi = np.searchsorted(self.dups[:, 0], [i, i + 1])
+            d.also = tuple((self.sources[int(s)], int(p), int(c)) for _, s, p, c in self.dups[lo:hi])
+        return d
+
+def open_bundle(bundle_dir: str):
+    with open(os.path.join(bundle_dir, "meta.json")) as f:
+        meta = json.load(f)
+    if meta.get("format") != BUNDLE_FORMAT:
+        raise RuntimeError(f"Unsupported index format in {bundle_dir}: {meta.get('format')}")
+    n, dim = meta["n_chunks"], meta["dim"]
+    vecs = _map(os.path.join(bundle_dir, "vecs.bin"), np.dtype(meta["vec_dtype"]), (n, dim))
+    return ChunkStore(bundle_dir, meta), vecs, meta
+
+# ---------------- Chunk dedup ----------------
+# Build-time duplicate detection in corpus order; the first occurrence of a text is the one kept.
+#   exact: same text after case/whitespace normalisation
+#   near:  MinHash signatures over word 5-shingles, LSH-banded so only chunks sharing a band are
+#          compared; a duplicate needs estimated Jaccard similarity >= threshold to a kept chunk
+# State is flat arrays indexed by kept row, not per-chunk Python objects: signatures (4 B/perm)
+# and per-band bucket chains (4 B/band) are memmaps under work_dir when given; a 64-bit text
+# digest (8 B) and the bucket heads (24-48 B/band) stay in RAM. So memory is still O(kept
+# chunks), roughly 0.4-0.8 KB RAM each with the defaults, and capacity bounds the rows.
+_MINHASH_PRIME = (1 << 31) - 1  # keeps a*x+b inside uint64 for 32-bit shingle hashes
+
+# uint64 key -> int32 value, open addressing with double hashing (at most half full, so a batch
+# of keys settles in a few vectorized probe rounds); key 0 marks an empty slot
+class _IntTable:
+    def __init__(self, size: int = 1024):
+        self.keys = np.zeros(size, dtype=np.uint64)
+        self.vals = np.full(size, -1, dtype=np.int32)
+        self.n = 0
+
+    # slot holding each key, or the empty slot where it would go
+    def _slots(self, keys: np.ndarray) -> np.ndarray:
+        mask = np.uint64(len(self.keys) - 1)
+        h = (keys ^ (keys >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)  # splitmix64 finalizer
+        h = (h ^ (h >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        h ^= h >> np.uint64(31)
+        idx, step = h & mask, (h >> np.uint64(32)) | np.uint64(1)  # odd step visits every slot
+        while True:
+            k = self.keys[idx]
+            probing = (k != keys) & (k != 0)
+            if not probing.any():
+                return idx
+            idx[probing] = (idx[probing] + step[probing]) & mask
+
+    def get(self, keys: np.ndarray) -> np.ndarray:
+        idx = self._slots(keys)
+        return np.where(self.keys[idx] == keys, self.vals[idx], -1)
+
+    # keys must be distinct
+    def put(self, keys: np.ndarray, vals: np.ndarray):
+        if 2 * (self.n + len(keys)) > len(self.keys):
+            live = np.flatnonzero(self.keys)
+            old_keys, old_vals = self.keys[live], self.vals[live]
+            size = len(self.keys)
+            while 2 * (len(live) + len(keys)) > size:
+                size *= 2
+            self.keys, self.vals, self.n = np.zeros(size, dtype=np.uint64), np.full(size, -1, dtype=np.int32), 0
+            self.put(old_keys, old_vals)
+        while len(keys):
+            idx = self._slots(keys)
+            slots, first = np.unique(idx, return_index=True)  # keys racing for one empty slot: first wins
+            self.n += int((self.keys[slots] == 0).sum())
+            self.keys[slots], self.vals[slots] = keys[first], vals[first]
+            rest = np.ones(len(keys), dtype=bool)
+            rest[first] = False
+            keys, vals = keys[rest], vals[rest]
+
+class ChunkDeduper:
+    def __init__(self, threshold: float = 0.8, capacity: int = 0, work_dir: Optional[str] = None,
+                 num_perm: int = 64, bands: int = 16, shingle: int = 5, seed: int = 1):
+        rng = np.random.default_rng(seed)
+        self.a = rng.integers(1, _MINHASH_PRIME, num_perm, dtype=np.uint64)[:, None]
+        self.b = rng.integers(0, _MINHASH_PRIME, num_perm, dtype=np.uint64)[:, None]
+        self.threshold = threshold
+        self.bands, self.rows = bands, num_perm // bands
+        self.shingle = shingle
+        self._salt = (np.arange(1, bands + 1, dtype=np.uint64) * np.uint64(0x9E3779B97F4A7C15))
+        def rows(name, width, dtype):
+            if work_dir is None:
+                return np.zeros((capacity, width), dtype=dtype)
+            return np.memmap(os.path.join(work_dir, name), dtype=dtype, mode="w+", shape=(max(capacity, 1), width))
+        self.sigs = rows("sigs.bin", num_perm, np.uint32)   # kept row -> signature
+        self.chain = rows("chain.bin", bands, np.int32)     # kept row -> previous kept row in its band-b bucket
+        self.digests = np.zeros(capacity, dtype=np.uint64)  # kept row -> normalised text digest
+        self.heads = _IntTable()                            # (band, band values) key -> last kept row in bucket
+        self.n_exact = self.n_near = 0
+
+    def signature(self, words: List[str]) -> np.ndarray:
+        w = self.shingle
+        grams = [" ".join(words[i:i + w]) for i in range(max(1, len(words) - w + 1))]
+        x = np.fromiter((zlib.crc32(g.encode()) for g in grams), dtype=np.uint64, count=len(grams))
+        return ((self.a * x[None, :] + self.b) % _MINHASH_PRIME).min(axis=1).astype(np.uint32)
+
+    # one 64-bit bucket key per band (FNV-style over the band's values, salted by band; never 0)
+    def band_keys(self, sig: np.ndarray) -> np.ndarray:
+        v = sig.reshape(self.bands, self.rows).astype(np.uint64)
+        k = self._salt.copy()
+        for r in range(self.rows):
+            k = (k ^ v[:, r]) * np.uint64(0x100000001B3)
+        k[k == 0] = 1
+        return k
+
+    # -> the kept row `text` duplicates, or None (and `text` is registered as kept under `row`,
+    # rows counting up from 0). Exact copies share every band, so they surface as candidates too.
+    def check(self, text: str, row: int) -> Optional[int]:
+        words = text.lower().split()
+        digest = int.from_bytes(hashlib.sha1(" ".join(words).encode()).digest()[:8], "little")
+        sig = self.signature(words)
+        keys = self.band_keys(sig)
+        heads = self.heads.get(keys)
+        best, best_j, seen = None, self.threshold, set()
+        for b in np.flatnonzero(heads >= 0):
+            cand = int(heads[b])
+            while cand >= 0:
+                if cand not in seen:
+                    seen.add(cand)
+                    if int(self.digests[cand]) == digest:
+                        self.n_exact += 1
+                        return cand
+                    j = float(np.mean(self.sigs[cand] == sig))
+                    if j >= best_j:
+                        best, best_j = cand, j
+                cand = int(self.chain[cand, b])
+        if best is not None:
+            self.n_near += 1
+            return best
+        self.digests[row] = digest
+        self.sigs[row] = sig
+        self.chain[row] = heads
+        self.heads.put(keys, np.full(self.bands, row, dtype=np.int32))
+        return None
+
+# ---------------- Chunk token ids ----------------
+# LM token ids of every chunk (CSR: ids[offsets[i]:offsets[i+1]]), computed once per bundle and
+# tokenizer so context packing never re-tokenizes chunk text at query time.
+class ChunkTokens:
+    def __init__(self, ids: np.ndarray, offsets: np.ndarray):
+        self.ids = ids
+        self.offsets = offsets
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i: int) -> List[int]:
+        return self.ids[self.offsets[i]:self.offsets[i + 1]].tolist()
+
+    @classmethod
+    def build(cls, documents, encode, prefix: str, block: int = 1024):
+        n = len(documents)
+        text = documents.text if hasattr(documents, "text") else (lambda i: documents[i].text)
+        offsets = np.zeros(n + 1, dtype=np.int64)
+        with open(prefix + "_ids.bin.tmp", "wb") as f:
+            for i in range(0, n, block):
+                j = min(n, i + block)
+                batch = encode([text(r) for r in range(i, j)])
+                offsets[i + 1:j + 1] = offsets[i] + np.cumsum([len(b) for b in batch])
+                f.write(np.fromiter((t for b in batch for t in b), dtype=np.int32, count=int(offsets[j] - offsets[i])).tobytes())
+        np.save(prefix + "_offsets.npy", offsets)
+        os.replace(prefix + "_ids.bin.tmp", prefix + "_ids.bin")  # last: its presence marks a complete sidecar
+        return cls.load(prefix)
+
+    @classmethod
+    def load(cls, prefix: str):
+        return cls(_map(prefix + "_ids.bin", np.int32), np.load(prefix + "_offsets.npy"))
+
+def _tokens_prefix(bundle_path: str, model_id: str) -> str:
+    return _sidecar_prefix(bundle_path, "tokens-" + hashlib.sha1(model_id.encode()).hexdigest()[:12])
+
+def load_lm_tokenizer(model_id: str):
+    return transformers.AutoTokenizer.from_pretrained(model_id, use_fast=True, trust_remote_code=True,
+                                                      **({"use_auth_token": HF_TOKEN} if HF_TOKEN else {}))
+
+# Batch encoder over the model's tokenizer.json with the `tokenizers` library: the same ids as
+# the fast AutoTokenizer (no special tokens) without importing transformers at build time.
+def load_chunk_encoder(model_id: str):
+    Tokenizer = _import("tokenizers").Tokenizer
+    path = os.path.join(model_id, "tokenizer.json")
+    tk = Tokenizer.from_file(path) if os.path.isfile(path) else Tokenizer.from_pretrained(model_id, auth_token=HF_TOKEN)
+    return lambda texts: [e.ids for e in tk.encode_batch(texts, add_special_tokens=False)]
+
+# Existing sidecar for this (bundle, tokenizer), else build it when `encode` is given, else None
+# (packing then tokenizes hits on demand).
+def load_chunk_tokens(documents, bundle_path: Optional[str], model_id: str, encode=None) -> Optional[ChunkTokens]:
+    if not bundle_path:
+        return None
+    prefix = _tokens_prefix(bundle_path, model_id)
+    if os.path.exists(prefix + "_ids.bin"):
+        try:
+            tokens = ChunkTokens.load(prefix)
+            if len(tokens) == len(documents):
+                return tokens
+        except Exception as e:
+            print(f"⚠️ Ignoring chunk token ids ({e})")
+    if encode is None:
+        return None
+    t0 = time.time()
+    tokens = ChunkTokens.build(documents, encode, prefix)
+    print(f"🔢 Chunk token ids: {len(tokens.ids)} tokens for {len(tokens)} chunks in {time.time()-t0:.1f}s")
+    return tokens
+
 # ---------------- Fast PDF extraction ----------------
-def _extract_pdf_pages_pymupdf(pdf_path: str, max_pages: Optional[int]) -> List[str]:
-    fitz = _ensure("fitz", "PyMuPDF")
-    doc = fitz.open(pdf_path)
+def _extract_pdf_pages_pymupdf(pdf_path: str, max_pages: Optional[int], start: int = 0) -> List[str]:
+    doc = _import("fitz").open(pdf_path)
     total = len(doc)
     pages = total if max_pages is None else min(max_pages, total)
     out = []
-    for i in range(pages):
+    for i in range(start, pages):
         try:
             t = doc[i].get_text("text") or ""
             t = SimpleTextProcessor.clean_text(t)
@@ -235,14 +1513,14 @@ def _extract_pdf_pages_pymupdf(pdf_path: str, max_pages: Optional[int]) -> List[
     doc.close()
     return out
 
-def _extract_pdf_pages_pypdf(pdf_path: str, max_pages: Optional[int]) -> List[str]:
+def _extract_pdf_pages_pypdf(pdf_path: str, max_pages: Optional[int], start: int = 0) -> List[str]:
     with open(pdf_path, "rb") as f:
         data = f.read()
-    reader = PdfReader(io.BytesIO(data))
+    reader = _pdf_reader()(io.BytesIO(data))
     total = len(reader.pages)
     pages = total if max_pages is None else min(max_pages, total)
     out = []
-    for i in range(pages):
+    for i in range(start, pages):
         try:
             t = reader.pages[i].extract_text() or ""
             t = SimpleTextProcessor.clean_text(t)
@@ -251,18 +1529,87 @@ def _extract_pdf_pages_pypdf(pdf_path: str, max_pages: Optional[int]) -> List[st
             print(f"Warning (pypdf): page {i+1} in {os.path.basename(pdf_path)} failed: {e}")
     return out
 
-def extract_pdf_text_fast(pdf_path: str, max_pages: Optional[int]) -> List[str]:
-    if config.USE_PYMUPDF:
+# Pages [start, max_pages) of a PDF; non-empty pages only, in order
+def extract_pdf_text_fast(pdf_path: str, max_pages: Optional[int], start: int = 0,
+                          use_pymupdf: Optional[bool] = None) -> List[str]:
+    if config.USE_PYMUPDF if use_pymupdf is None else use_pymupdf:
         try:
-            return _extract_pdf_pages_pymupdf(pdf_path, max_pages)
+            return _extract_pdf_pages_pymupdf(pdf_path, max_pages, start)
         except Exception as e:
             print("PyMuPDF not available / failed, falling back:", e)
-    return _extract_pdf_pages_pypdf(pdf_path, max_pages)
+    return _extract_pdf_pages_pypdf(pdf_path, max_pages, start)
+
+def pdf_page_count(pdf_path: str, max_pages: Optional[int]) -> int:
+    total = None
+    if config.USE_PYMUPDF:
+        try:
+            with _import("fitz").open(pdf_path) as doc:
+                total = len(doc)
+        except Exception:
+            pass
+    if total is None:
+        total = len(_pdf_reader()(pdf_path).pages)
+    return total if max_pages is None else min(max_pages, total)
+
+# ---------------- Parallel extraction + chunking ----------------
+# Work unit for the process pool: a page range of one PDF. Everything the worker needs travels
+# in the task, so results don't depend on the child's copy of `config`.
+@dataclass
+class ExtractTask:
+    path: str
+    start: int
+    stop: int
+    max_tokens: int
+    overlap: int
+    use_pymupdf: bool
+
+def _extract_chunk_task(task: ExtractTask):
+    t0 = time.perf_counter()
+    pages = extract_pdf_text_fast(task.path, task.stop, task.start, task.use_pymupdf)
+    chunks = [create_chunks(txt, task.max_tokens, task.overlap) for txt in pages]
+    return chunks, time.perf_counter() - t0
+
+def iter_extract_chunks(tasks: List[ExtractTask], n_workers: int):
+    # Yields (task, per-page chunk lists, worker seconds) strictly in task order, keeping at most
+    # 2*n_workers ranges in flight so extraction runs ahead of the embedder without piling up.
+    if n_workers <= 1 or len(tasks) <= 1:
+        for t in tasks:
+            yield (t, *_extract_chunk_task(t))
+        return
+    with ProcessPoolExecutor(max_workers=n_workers) as ex:
+        it = iter(tasks)
+        pending = deque((t, ex.submit(_extract_chunk_task, t)) for t in islice(it, 2 * n_workers))
+        while pending:
+            t, fut = pending.popleft()
+            nxt = next(it, None)
+            if nxt is not None:
+                pending.append((nxt, ex.submit(_extract_chunk_task, nxt)))
+            yield (t, *fut.result())
 
 # ---------------- Model Loader (lazy) ----------------
+# CPU inference backends, applied to a loaded float32 model. int8 swaps every nn.Linear (lm_head
+# included) for a dynamically quantised one: int8 weights, activations quantised per batch.
+LM_BACKENDS = ("float32", "int8", "compile")
+
+def lm_backend_options(backend: str) -> set:
+    opts = {o.strip() for o in (backend or "").split(",") if o.strip()}
+    unknown = opts - set(LM_BACKENDS)
+    if unknown:
+        raise ValueError(f"Unknown LM_BACKEND option(s) {sorted(unknown)}; expected {LM_BACKENDS}")
+    return opts - {"float32"}
+
+def optimize_lm(model, opts: set):
+    if "int8" in opts:
+        model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+    if "compile" in opts:
+        model.forward = torch.compile(model.forward, dynamic=True)
+    return model
+
 class SafeModelManager:
-    def __init__(self, model_id: str):
+    def __init__(self, model_id: str, backend: Optional[str] = None):
         self.model_id = model_id
+        self.backend = config.LM_BACKEND if backend is None else backend
+        lm_backend_options(self.backend)  # fail fast on a typo
         self.tok = None
         self.model = None
 
@@ -273,22 +1620,15 @@ class SafeModelManager:
         for mid in [self.model_id] + [m for m in FALLBACK_MODELS if m != self.model_id]:
             try:
                 print(f"Loading LM: {mid}")
-                self.tok = AutoTokenizer.from_pretrained(mid, use_fast=True, trust_remote_code=True, **self._hf_auth())
+                self.tok = load_lm_tokenizer(mid)
                 if self.tok.pad_token is None:
                     self.tok.pad_token = self.tok.eos_token if getattr(self.tok, "eos_token", None) else self.tok.unk_token
-                self.model = AutoModelForCausalLM.from_pretrained(
-                    mid,
-                    trust_remote_code=True,
-                    torch_dtype=config.DTYPE,
-                    device_map="auto" if config.DEVICE == "cuda" else None,
-                    low_cpu_mem_usage=True,
-                    **self._hf_auth()
-                )
-                if config.DEVICE != "cuda":
-                    self.model = self.model.to(config.DEVICE)
-                self.model.eval()
+                self.tok.padding_side = "left"  # decoder-only: batched prompts must end at the same position
+                self.model = self._load_weights(mid)
                 self.model_id = mid
-                print(f"✅ LM ready: {mid}")
+                if config.DEVICE != "cuda":
+                    self._apply_backend()
+                print(f"✅ LM ready: {mid} ({self.backend})")
                 return
             except Exception as e:
                 print(f"❌ Failed {mid}: {e}")
@@ -300,6 +1640,43 @@ class SafeModelManager:
                     torch.cuda.empty_cache()
         raise RuntimeError("No model could be loaded.")
 
+    def _load_weights(self, mid: str):
+        model = transformers.AutoModelForCausalLM.from_pretrained(
+            mid,
+            trust_remote_code=True,
+            torch_dtype=config.DTYPE,
+            device_map="auto" if config.DEVICE == "cuda" else None,
+            low_cpu_mem_usage=True,
+            **self._hf_auth()
+        )
+        if config.DEVICE != "cuda":
+            model = model.to(config.DEVICE)
+        return model.eval()
+
+    # Options are applied one at a time (int8, then compile) and self.backend ends up naming only
+    # those that took. A failing option (e.g. no C++ toolchain for compile) keeps the model as it
+    # was before that option rather than falling through to the next model; int8 quantises in
+    # place, so if it fails midway the float32 weights are reloaded.
+    def _apply_backend(self):
+        opts = lm_backend_options(self.backend)
+        applied = []
+        for opt in [o for o in LM_BACKENDS if o in opts]:
+            try:
+                self.model = optimize_lm(self.model, {opt})
+                if opt == "compile":  # compile now, not on the first request
+                    ids = self.tok.encode("Hello", return_tensors="pt").to(self.model.device)
+                    self.model.generate(input_ids=ids, attention_mask=torch.ones_like(ids), max_new_tokens=2,
+                                        do_sample=False, pad_token_id=self.tok.pad_token_id)
+                applied.append(opt)
+            except Exception as e:
+                print(f"⚠️ LM backend option {opt!r} failed ({e}); continuing without it")
+                if opt == "int8":
+                    self.model = self._load_weights(self.model_id)
+                vars(self.model).pop("forward", None)  # drop a compiled wrapper
+                break
+        if opts:
+            self.backend = ",".join(applied) or "float32"
+
     def cleanup(self):
         try:
             del self.model; del self.tok
@@ -308,6 +1685,455 @@ class SafeModelManager:
         if config.DEVICE == "cuda":
             torch.cuda.empty_cache()
 
+# ---------------- Generation ----------------
+STOP_MARKERS = ["<|user|>", "<|system|>", "<|context|>"]
+
+def trim_stops(text: str) -> str:
+    text = text.strip()
+    for stop in STOP_MARKERS:
+        if stop in text:
+            text = text.split(stop)[0].strip()
+    return text
+
+def generation_kwargs(tok) -> dict:
+    return dict(
+        max_new_tokens=config.MAX_NEW_TOKENS,
+        do_sample=True,
+        temperature=config.TEMPERATURE,
+        top_p=config.TOP_P,
+        repetition_penalty=config.REPETITION_PENALTY,
+        pad_token_id=getattr(tok, "eos_token_id", tok.pad_token_id),
+        eos_token_id=getattr(tok, "eos_token_id", tok.pad_token_id)
+    )
+
+# Incremental version of trim_stops(): passes text through until a stop marker appears,
+# holding back any tail that could still turn into one.
+class StopMarkerFilter:
+    def __init__(self, markers: List[str] = STOP_MARKERS):
+        self.markers = markers
+        self.buf = ""
+        self.started = False
+        self.stopped = False
+
+    def _emit(self, text: str) -> str:
+        if not self.started:
+            text = text.lstrip()
+            self.started = bool(text)
+        return text
+
+    def feed(self, piece: str) -> str:
+        if self.stopped:
+            return ""
+        self.buf += piece
+        cut = min((self.buf.find(m) for m in self.markers if m in self.buf), default=-1)
+        if cut >= 0:
+            self.stopped = True
+            out, self.buf = self.buf[:cut].rstrip(), ""
+            return self._emit(out)
+        hold = 0
+        for m in self.markers:
+            for n in range(min(len(m) - 1, len(self.buf)), hold, -1):
+                if self.buf.endswith(m[:n]):
+                    hold = n
+                    break
+        # trailing whitespace waits too: trim_stops() drops it if a marker or the end follows
+        out = self.buf[:len(self.buf) - hold].rstrip()
+        self.buf = self.buf[len(out):]
+        return self._emit(out)
+
+    def flush(self) -> str:
+        out, self.buf = self.buf, ""
+        return "" if self.stopped else self._emit(out.rstrip())
+
+# Stopping criterion (duck-typed, so defining it does not import transformers). Per row: a
+# cancelled or overdue request stops decoding at the next token while the rest of its batch carries on
+class RequestStop:
+    def __init__(self, reqs: list):
+        self.reqs = reqs
+
+    def __call__(self, input_ids, scores, **kwargs):
+        return torch.tensor([r.expired() for r in self.reqs], dtype=torch.bool, device=input_ids.device)
+
+# Every prompt starts with one of a handful of fixed "<|system|>...<|context|>" prefixes (one per
+# domain). Their key/value states are computed once per model and generate() resumes from them,
+# so only the context and question go through the model. Cached tensors are shared read-only:
+# DynamicCache.update concatenates into new tensors, so concurrent requests never see each
+# other's tokens. Only single-sequence generate() calls use it (left padding shifts the prefix).
+class PrefixKVCache:
+    def __init__(self, mm: SafeModelManager, max_prefixes: int = 16):
+        self.mm = mm
+        self.max_prefixes = max_prefixes
+        self._prefixes: "OrderedDict[tuple, Optional[tuple]]" = OrderedDict()  # prefix ids -> legacy KV (lazy)
+        self._model_key = None
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.reused_tokens = 0
+        self.error: Optional[str] = None  # set once the model turns out not to support it
+
+    def add(self, prefix: List[int]):
+        key = tuple(prefix)
+        with self._lock:
+            if key in self._prefixes:
+                return
+            self._prefixes[key] = None
+            while len(self._prefixes) > self.max_prefixes:
+                self._prefixes.popitem(last=False)
+
+    # -> (n cached prompt tokens, fresh DynamicCache to pass as past_key_values) or (0, None)
+    def lookup(self, ids: List[int]):
+        if self.error is not None:
+            return 0, None
+        with self._lock:
+            model_key = (self.mm.model_id, id(self.mm.model))
+            if model_key != self._model_key:  # model (re)loaded: every cached state is stale
+                self._prefixes = OrderedDict((k, None) for k in self._prefixes)
+                self._model_key = model_key
+            key = next((p for p in self._prefixes if len(p) < len(ids) and tuple(ids[:len(p)]) == p), None)
+            if key is None:
+                self.misses += 1
+                return 0, None
+            kv = self._prefixes[key]
+            if kv is None:
+                try:
+                    kv = self._prefixes[key] = self._compute(key)
+                except Exception as e:
+                    self.error = str(e)
+                    print(f"⚠️ Prefix KV cache disabled: {e}")
+                    return 0, None
+            self._prefixes.move_to_end(key)
+            self.hits += 1
+            self.reused_tokens += len(key)
+        return len(key), transformers.DynamicCache.from_legacy_cache(kv)
+
+    def _compute(self, prefix: tuple) -> tuple:
+        model = self.mm.model
+        if not getattr(model, "_supports_cache_class", False):
+            raise RuntimeError(f"{type(model).__name__} does not support Cache objects")
+        with torch.no_grad():
+            out = model(input_ids=torch.tensor([prefix], dtype=torch.long, device=model.device),
+                        past_key_values=transformers.DynamicCache(), use_cache=True)
+        past = out.past_key_values
+        return past.to_legacy_cache() if hasattr(past, "to_legacy_cache") else past
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"prefixes": len(self._prefixes), "warm": sum(v is not None for v in self._prefixes.values()),
+                    "hits": self.hits, "misses": self.misses, "reused_tokens": self.reused_tokens,
+                    "error": self.error}
+
+class Overloaded(RuntimeError):
+    pass  # MAX_PENDING_REQUESTS questions already in flight
+
+class _GenRequest:
+    __slots__ = ("prompt", "done", "text", "error", "t_submit", "gen_ms", "batch_size", "prefix_tokens", "new_tokens",
+                 "cancel", "deadline", "on_done")
+    def __init__(self, prompt: List[int], cancel: Optional[threading.Event] = None, deadline: Optional[float] = None,
+                 on_done=None):
+        self.prompt = prompt  # token ids
+        self.done = threading.Event()
+        self.text: Optional[str] = None
+        self.error: Optional[BaseException] = None
+        self.t_submit = time.perf_counter()
+        self.gen_ms = 0.0
+        self.batch_size = 0
+        self.prefix_tokens = 0
+        self.new_tokens = 0
+        self.cancel = cancel      # set by the caller to give up on this request
+        self.deadline = deadline  # time.perf_counter() value
+        self.on_done = on_done    # called with the request on the scheduler thread once done is set
+
+    def expired(self) -> bool:
+        return (self.cancel is not None and self.cancel.is_set()) or \
+               (self.deadline is not None and time.perf_counter() > self.deadline)
+
+    # After generation stopped early: a cancelled caller is gone, an overdue one gets TimeoutError
+    def fail_if_expired(self):
+        if self.cancel is not None and self.cancel.is_set():
+            self.error = RuntimeError("request cancelled")
+        elif self.deadline is not None and time.perf_counter() > self.deadline:
+            self.error = TimeoutError("request deadline passed")
+
+# Coalesces concurrent prompts into left-padded micro-batches for one generate() call.
+# The first queued request opens a window of `wait_ms`; anything arriving inside it (up to
+# `max_batch`) rides along. Callers block in submit() and get back their own trimmed text, or
+# enqueue() and get called back. Requests cancelled or overdue while queued are dropped unrun;
+# once running, they stop decoding at the next token.
+class GenerationScheduler:
+    def __init__(self, mm: SafeModelManager, max_batch: int, wait_ms: float,
+                 prefix_cache: Optional[PrefixKVCache] = None, lock: Optional[threading.Lock] = None):
+        self.mm = mm
+        self.prefix_cache = prefix_cache
+        self.lock = lock  # shared with unbatched generate() calls on the same model, if any
+        self.max_batch = max(1, max_batch)
+        self.wait_s = max(0.0, wait_ms) / 1000.0
+        self._q: "queue.Queue[_GenRequest]" = queue.Queue()
+        self._stats_lock = threading.Lock()
+        self._latencies_ms = deque(maxlen=2048)
+        self._batch_sizes = [0] * (self.max_batch + 1)
+        self._n_requests = 0
+        self._n_batches = 0
+        self.dropped = 0  # cancelled / overdue before they ran
+        threading.Thread(target=self._loop, name="gen-scheduler", daemon=True).start()
+
+    def submit(self, prompt: List[int], cancel: Optional[threading.Event] = None,
+               deadline: Optional[float] = None) -> _GenRequest:
+        req = self.enqueue(prompt, cancel, deadline)
+        req.done.wait()
+        if req.error is not None:
+            raise req.error
+        return req
+
+    def enqueue(self, prompt: List[int], cancel: Optional[threading.Event] = None, deadline: Optional[float] = None,
+                on_done=None) -> _GenRequest:
+        req = _GenRequest(prompt, cancel, deadline, on_done)
+        self._q.put(req)
+        return req
+
+    def _collect(self) -> List[_GenRequest]:
+        batch = [self._q.get()]
+        deadline = time.perf_counter() + self.wait_s
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.perf_counter()
+            try:
+                batch.append(self._q.get(timeout=remaining) if remaining > 0 else self._q.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _loop(self):
+        while True:
+            batch = self._collect()
+            expired = [r.expired() for r in batch]
+            dropped = [r for r, e in zip(batch, expired) if e]
+            batch = [r for r, e in zip(batch, expired) if not e]
+            for r in dropped:
+                r.fail_if_expired()
+                self._finish(r)
+            self.dropped += len(dropped)
+            if not batch:
+                continue
+            try:
+                self._run(batch)
+            except BaseException as e:
+                for r in batch:
+                    r.error = e
+            finally:
+                self._record(batch)
+                for r in batch:
+                    self._finish(r)
+
+    @staticmethod
+    def _finish(r: _GenRequest):
+        r.done.set()
+        if r.on_done is not None:
+            try:
+                r.on_done(r)
+            except Exception:
+                pass  # e.g. the caller's event loop already closed
+
+    def _run(self, batch: List[_GenRequest]):
+        tok, model = self.mm.tok, self.mm.model
+        width = max(len(r.prompt) for r in batch)
+        pad = [[0] * (width - len(r.prompt)) for r in batch]  # left padding
+        input_ids = torch.tensor([[tok.pad_token_id] * len(p) + r.prompt for p, r in zip(pad, batch)], device=model.device)
+        attention_mask = torch.tensor([p + [1] * len(r.prompt) for p, r in zip(pad, batch)], device=model.device)
+        past = {}
+        if len(batch) == 1 and self.prefix_cache is not None:
+            batch[0].prefix_tokens, kv = self.prefix_cache.lookup(batch[0].prompt)
+            past = {"past_key_values": kv} if kv is not None else {}
+        kw = generation_kwargs(tok)
+        t0 = time.perf_counter()
+        with self.lock or nullcontext(), torch.no_grad():
+            gen = model.generate(input_ids=input_ids, attention_mask=attention_mask, **past, **kw,
+                                 stopping_criteria=transformers.StoppingCriteriaList([RequestStop(batch)]))
+        gen_ms = (time.perf_counter() - t0) * 1000
+        prompt_len = input_ids.shape[1]
+        # rows that finish early are padded out to the longest with pad_token_id (= EOS here), so
+        # a row's own tokens run up to and including its first EOS
+        ended = gen[:, prompt_len:] == kw["eos_token_id"]
+        for i, r in enumerate(batch):
+            r.text = trim_stops(tok.decode(gen[i, prompt_len:], skip_special_tokens=True))
+            r.new_tokens = int(ended[i].int().argmax()) + 1 if ended[i].any() else gen.shape[1] - prompt_len
+            r.gen_ms = gen_ms
+            r.batch_size = len(batch)
+            r.fail_if_expired()
+
+    def _record(self, batch: List[_GenRequest]):
+        now = time.perf_counter()
+        with self._stats_lock:
+            self._n_batches += 1
+            self._n_requests += len(batch)
+            self._batch_sizes[len(batch)] += 1
+            for r in batch:
+                self._latencies_ms.append((now - r.t_submit) * 1000)
+
+    def stats(self) -> dict:
+        with self._stats_lock:
+            lat = sorted(self._latencies_ms)
+            n_req, n_batch = self._n_requests, self._n_batches
+            sizes = list(self._batch_sizes)
+        pct = lambda p: round(lat[min(len(lat) - 1, int(p / 100 * len(lat)))], 2) if lat else None
+        return {
+            "requests": n_req,
+            "batches": n_batch,
+            "dropped": self.dropped,
+            "queue_depth": self._q.qsize(),
+            "max_batch": self.max_batch,
+            "wait_ms": self.wait_s * 1000,
+            "mean_batch_size": round(n_req / n_batch, 3) if n_batch else 0.0,
+            "occupancy": round(n_req / (n_batch * self.max_batch), 3) if n_batch else 0.0,
+            "batch_size_hist": {str(i): c for i, c in enumerate(sizes) if i and c},
+            "latency_ms": {"p50": pct(50), "p95": pct(95), "p99": pct(99)},
+        }
+
+# ---------------- Caching ----------------
+# Thread-safe LRU with per-entry TTL and hit/miss counters
+class LRUCache:
+    def __init__(self, name: str, maxsize: int, ttl_s: float):
+        self.name = name
+        self.maxsize = max(1, maxsize)
+        self.ttl_s = ttl_s
+        self._d: "OrderedDict[object, Tuple[float, object]]" = OrderedDict()  # key -> (expires_at, value)
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.evictions = self.expirations = 0
+
+    def __len__(self) -> int:
+        return len(self._d)
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._d.get(key)
+            if item is not None and item[0] < time.time():
+                del self._d[key]
+                self.expirations += 1
+                item = None
+            if item is None:
+                self.misses += 1
+                return default
+            self._d.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    def put(self, key, value):
+        with self._lock:
+            self._d[key] = (time.time() + self.ttl_s, value)
+            self._d.move_to_end(key)
+            while len(self._d) > self.maxsize:
+                self._d.popitem(last=False)
+                self.evictions += 1
+
+    def prune(self, keep):
+        with self._lock:
+            for k in [k for k in self._d if not keep(k)]:
+                del self._d[k]
+
+    def clear(self):
+        with self._lock:
+            self._d.clear()
+
+    def items(self) -> list:
+        now = time.time()
+        with self._lock:
+            return [(k, exp, v) for k, (exp, v) in self._d.items() if exp >= now]
+
+    def restore(self, items: list):
+        now = time.time()
+        with self._lock:
+            for k, exp, v in items:
+                if exp >= now:
+                    self._d[k] = (exp, v)
+            while len(self._d) > self.maxsize:
+                self._d.popitem(last=False)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {"size": len(self._d), "maxsize": self.maxsize, "ttl_s": self.ttl_s,
+                "hits": self.hits, "misses": self.misses, "hit_rate": round(self.hits / total, 4) if total else 0.0,
+                "evictions": self.evictions, "expirations": self.expirations}
+
+def save_caches(path: str, caches: List[LRUCache]):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        pickle.dump({c.name: c.items() for c in caches}, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp, path)
+
+def load_caches(path: str, caches: List[LRUCache]):
+    try:
+        with open(path, "rb") as f:
+            data = pickle.load(f)
+    except FileNotFoundError:
+        return
+    except Exception as e:
+        print(f"⚠️ Ignoring unreadable cache file {path}: {e}")
+        return
+    for c in caches:
+        c.restore(data.get(c.name, []))
+
+# Small vector index over previously answered questions (one row per answer)
+class SemanticAnswerCache:
+    name = "semantic"
+
+    def __init__(self, capacity: int, threshold: float, ttl_s: float):
+        self.capacity = max(1, capacity)
+        self.threshold = threshold
+        self.ttl_s = ttl_s
+        self.vecs: Optional[np.ndarray] = None           # capacity x dim, allocated on first add
+        self.valid = np.zeros(self.capacity, dtype=bool)
+        self.last_used = np.zeros(self.capacity)
+        self.entries: List[Optional[tuple]] = [None] * self.capacity  # (bundle_id, chunk ids, answer, expires_at)
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.chunk_mismatches = 0
+
+    def lookup(self, bundle_id: str, qv: np.ndarray, chunk_ids: frozenset) -> Optional[str]:
+        with self._lock:
+            if self.vecs is None or not self.valid.any():
+                self.misses += 1
+                return None
+            sims = self.vecs @ qv
+            sims[~self.valid] = -np.inf
+            now = time.time()
+            for j in np.flatnonzero(sims >= self.threshold)[np.argsort(-sims[sims >= self.threshold])]:
+                b, ids, text, exp = self.entries[j]
+                if exp < now:
+                    self.valid[j] = False
+                    continue
+                if b == bundle_id and ids == chunk_ids:
+                    self.last_used[j] = now
+                    self.hits += 1
+                    return text
+                self.chunk_mismatches += 1
+            self.misses += 1
+            return None
+
+    def add(self, bundle_id: str, qv: np.ndarray, chunk_ids: frozenset, text: str):
+        with self._lock:
+            if self.vecs is None:
+                self.vecs = np.zeros((self.capacity, len(qv)), dtype=np.float32)
+            free = np.flatnonzero(~self.valid)
+            j = int(free[0]) if len(free) else int(np.argmin(self.last_used))  # evict least recently used
+            self.vecs[j] = qv
+            self.valid[j] = True
+            self.last_used[j] = time.time()
+            self.entries[j] = (bundle_id, chunk_ids, text, time.time() + self.ttl_s)
+
+    def prune(self, keep):
+        with self._lock:
+            for j in np.flatnonzero(self.valid):
+                if not keep(self.entries[j][:1]):
+                    self.valid[j] = False
+
+    def __len__(self) -> int:
+        return int(self.valid.sum())
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {"size": len(self), "maxsize": self.capacity, "threshold": self.threshold,
+                "hits": self.hits, "misses": self.misses, "hit_rate": round(self.hits / total, 4) if total else 0.0,
+                "chunk_mismatches": self.chunk_mismatches}
+
+def normalize_query(q: str) -> str:
+    return re.sub(r"\s+", " ", q.lower()).strip().rstrip("?!. ")
+
 # ---------------- Tiny domain router ----------------
 def route(query: str) -> str:
     q = query.lower()
@@ -331,129 +2157,850 @@ def system_preamble(domain: str) -> str:
     if domain == "budget":   return base + " Offer step-by-step budgeting guidance and templates."
     return base
 
+# ---------------- Tenant index shards ----------------
+# A tenant's index is whatever bundle its ref names: CACHE_DIR/refs/<tenant>.json, replaced
+# atomically at the end of --build. Bundles are content-addressed, so tenants uploading the same
+# PDFs share per-PDF shards (and whole bundles), and a rebuild never touches a bundle being read.
+_TENANT_RE = re.compile(r"[A-Za-z0-9_@-][A-Za-z0-9_.@-]{0,63}")
+
+def tenant_key(tenant: str) -> str:
+    tenant = str(tenant).strip()
+    if _TENANT_RE.fullmatch(tenant):
+        return tenant
+    return "t-" + hashlib.sha256(tenant.encode()).hexdigest()[:24]  # not safe as a file name
+
+def _ref_path(tenant: str) -> str:
+    return os.path.join(config.CACHE_DIR, "refs", tenant_key(tenant) + ".json")
+
+def read_index_ref(tenant: str) -> Optional[str]:
+    try:
+        with open(_ref_path(tenant)) as f:
+            path = os.path.join(config.CACHE_DIR, json.load(f)["bundle"])
+    except (FileNotFoundError, ValueError, KeyError):
+        return None
+    return path if os.path.exists(path) else None
+
+def write_index_ref(tenant: str, bundle_path: str):
+    path = _ref_path(tenant)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w") as f:
+        json.dump({"tenant": tenant, "bundle": os.path.basename(bundle_path), "updated": time.time()}, f)
+    os.replace(tmp, path)
+
+# tenant key -> bundle path, for every published tenant
+def index_refs() -> dict:
+    refs = {}
+    for p in glob.glob(os.path.join(config.CACHE_DIR, "refs", "*.json")):
+        path = read_index_ref(os.path.basename(p)[:-len(".json")])
+        if path:
+            refs[os.path.basename(p)[:-len(".json")]] = path
+    return refs
+
+# Rough resident size: every numpy array reachable from the shard's parts (memmaps count in full,
+# since searching pulls them into page cache)
+def _nbytes(*objs, depth: int = 4) -> int:
+    seen, total = set(), 0
+    stack = [(o, depth) for o in objs]
+    while stack:
+        o, d = stack.pop()
+        if o is None or id(o) in seen or d < 0:
+            continue
+        seen.add(id(o))
+        if isinstance(o, np.ndarray):
+            total += o.nbytes
+        elif isinstance(o, (list, tuple)):
+            stack += [(x, d - 1) for x in o if isinstance(x, np.ndarray)]
+        elif hasattr(o, "__dict__") or hasattr(o, "__slots__"):
+            fields = list(getattr(o, "__dict__", {}).values())
+            fields += [getattr(o, f, None) for f in getattr(type(o), "__slots__", ())]
+            stack += [(x, d - 1) for x in fields]
+    return total
+
+# One loaded bundle: chunks, vectors, vector index, BM25 and (lazily) chunk token ids
+class IndexShard:
+    def __init__(self, tenant: str, path: str):
+        self.tenant = tenant
+        self.path = path
+        if os.path.isdir(path):
+            self.documents, vecs, meta = open_bundle(path)
+            self.bundle_id = meta.get("bundle_id") or os.path.basename(path)
+        else:
+            self.bundle_id = os.path.splitext(os.path.basename(path))[0]
+            # legacy compressed .npz bundle: fully decoded into memory
+            arr = np.load(path, allow_pickle=True)
+            texts   = arr["texts"].tolist()
+            sources = arr["sources"].tolist()
+            pages   = arr["pages"].astype(int).tolist()
+            cids    = arr["cids"].astype(int).tolist()
+            vecs    = arr["vecs"].astype("float32")
+            self.documents = [Document(text=t, page=p, chunk_id=c, source=s, row=i)
+                              for i, (t, p, c, s) in enumerate(zip(texts, pages, cids, sources))]
+        self.doc_vecs = vecs
+        self.vindex = load_vector_index(vecs, path)
+        self.bm25 = load_bm25_index(self.documents, path) if config.HYBRID_SEARCH != "off" else None
+        self.chunk_tokens: Optional[ChunkTokens] = None
+        self._tokens_model = None  # model_id chunk_tokens was resolved for
+        self.nbytes = _nbytes(self.documents, self.doc_vecs, self.vindex, self.bm25)
+
+    def tokens(self, model_id: str) -> Optional[ChunkTokens]:
+        if self._tokens_model != model_id:
+            self.chunk_tokens = load_chunk_tokens(self.documents, self.path, model_id)
+            self._tokens_model = model_id
+        return self.chunk_tokens
+
+    # Dense (+ BM25 when hybrid) retrieval. Rows are ordered by the fused ranking, but the score
+    # reported for each is always its dense cosine, so CONFIDENCE_THRESHOLD (checked against the
+    # best of them, not whichever row fusion put first) keeps its meaning.
+    def search(self, qv: np.ndarray, query: str, k: int) -> List[Tuple[int, float]]:
+        dense, sparse = self.rankings(qv, query, k)
+        if not sparse:
+            return dense[:k]
+        rows = fuse_rankings(dense, sparse, k, config.HYBRID_SEARCH, config.RRF_K, config.HYBRID_DENSE_WEIGHT)
+        cos = self.cosines(qv, rows, dict(dense))
+        return [(i, cos[i]) for i in rows]
+
+    # (dense, sparse) candidate rankings before fusion; sparse is [] when hybrid search is off
+    def rankings(self, qv: np.ndarray, query: str, k: int):
+        if self.bm25 is None or config.HYBRID_SEARCH == "off":
+            return self.vindex.search(qv, k), []
+        n = max(k, config.HYBRID_CANDIDATES)
+        return self.vindex.search(qv, n), self.bm25.search(query, n, config.BM25_MAX_POSTINGS)
+
+    # row -> dense cosine, filling in rows only the sparse side found
+    def cosines(self, qv: np.ndarray, rows, known: dict) -> dict:
+        missing = [i for i in rows if i not in known]
+        if missing:
+            known.update(zip(missing, _dot(self.doc_vecs[np.array(missing)], qv).tolist()))
+        return {i: float(known[i]) for i in rows}
+
+# Loaded user overlays, keyed by tenant. A lookup stats the tenant's ref, so a rebuilt overlay is
+# picked up on the next question; past max_bytes / max_shards the least recently used shards are
+# dropped (their memmaps close once in-flight requests let go of them).
+class ShardPool:
+    def __init__(self, max_bytes: int, max_shards: int):
+        self.max_bytes = max_bytes
+        self.max_shards = max(1, max_shards)
+        self._d: "OrderedDict[str, Tuple[int, IndexShard]]" = OrderedDict()  # key -> (ref mtime_ns, shard)
+        self._lock = threading.Lock()
+        self.bytes = 0
+        self.hits = self.misses = self.loads = self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self._d)
+
+    def get(self, tenant: str) -> Optional[IndexShard]:
+        key = tenant_key(tenant)
+        try:
+            stamp = os.stat(_ref_path(tenant)).st_mtime_ns
+        except FileNotFoundError:
+            stamp = None  # no overlay (or it was removed)
+        with self._lock:
+            item = self._d.get(key)
+            if item is not None and item[0] == stamp:
+                self._d.move_to_end(key)
+                self.hits += 1
+                return item[1]
+            if item is not None:
+                self._drop(key)
+            if stamp is None:
+                return None
+            self.misses += 1
+        path = read_index_ref(tenant)
+        if path is None:
+            return None
+        shard = IndexShard(key, path)
+        with self._lock:
+            if key in self._d:
+                self._drop(key)  # a concurrent load won the race; keep the newer one
+            self._d[key] = (stamp, shard)
+            self.bytes += shard.nbytes
+            self.loads += 1
+            while len(self._d) > 1 and (self.bytes > self.max_bytes or len(self._d) > self.max_shards):
+                self._drop(next(iter(self._d)))
+                self.evictions += 1
+        return shard
+
+    def _drop(self, key: str):
+        self.bytes -= self._d.pop(key)[1].nbytes
+
+    def clear(self):
+        with self._lock:
+            self._d.clear()
+            self.bytes = 0
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {"loaded": len(self._d), "bytes": self.bytes, "max_bytes": self.max_bytes,
+                "max_shards": self.max_shards, "hits": self.hits, "misses": self.misses,
+                "hit_rate": round(self.hits / total, 4) if total else 0.0,
+                "loads": self.loads, "evictions": self.evictions}
+
 # ---------------- RAG Core ----------------
 class SimplePDFRAG:
     def __init__(self):
         self.mm: Optional[SafeModelManager] = None
-        self.embedder = STEmbedder("sentence-transformers/all-MiniLM-L6-v2", device=config.DEVICE)
-        self.documents: List[Document] = []
-        self.doc_vecs = None
+        self._embedder: Optional[STEmbedder] = None  # loaded on first embed (imports torch)
+        self._embedder_lock = threading.Lock()
+        self._reranker: Optional[CrossEncoderReranker] = None  # loaded on first re-rank (RERANK)
+        self.base: Optional[IndexShard] = None  # BASE_TENANT corpus, always resident
+        self.shards = ShardPool(config.SHARD_POOL_MAX_BYTES, config.SHARD_POOL_MAX_SHARDS)  # user overlays
+        self._token_memo = LRUCache("chunk_tokens", 4096, float("inf"))  # hits without a sidecar
         self._model_loaded = False
+        self._lm_lock = threading.Lock()
+        self.scheduler: Optional[GenerationScheduler] = None
+        self.prefix_cache: Optional[PrefixKVCache] = None
+        self._gen_worker: Optional[GenerationScheduler] = None  # async API generation thread without GEN_BATCHING
+        self._executor: Optional[ThreadPoolExecutor] = None     # async API retrieval threads
+        self._pending = 0  # questions in flight (async API and server)
+        self._pending_lock = threading.Lock()
+        self.rejected = 0
+        self.query_cache = self.answer_cache = None
+        if config.CACHE_ENABLED:
+            self.query_cache = LRUCache("query", config.QUERY_CACHE_SIZE, config.QUERY_CACHE_TTL_S)
+            self.answer_cache = LRUCache("answer", config.ANSWER_CACHE_SIZE, config.ANSWER_CACHE_TTL_S)
+            if config.CACHE_PERSIST_PATH:
+                load_caches(config.CACHE_PERSIST_PATH, self._caches())
+        self.semantic_cache = SemanticAnswerCache(config.SEMANTIC_CACHE_SIZE, config.SEMANTIC_CACHE_THRESHOLD,
+                                                  config.SEMANTIC_CACHE_TTL_S) if config.SEMANTIC_CACHE else None
+        telemetry.metrics.add_collector(self._gauges)
+
+    # The base corpus, as the attributes single-index callers (benchmarks, /health) read
+    documents = property(lambda self: self.base.documents if self.base else [])
+    doc_vecs = property(lambda self: self.base.doc_vecs if self.base else None)
+    vindex = property(lambda self: self.base.vindex if self.base else None)
+    bm25 = property(lambda self: self.base.bm25 if self.base else None)
+    bundle_id = property(lambda self: self.base.bundle_id if self.base else None)
+    index_path = property(lambda self: self.base.path if self.base else None)
+
+    # Index / cache / queue sizes, read when /metrics is scraped
+    def _gauges(self):
+        yield "rag_index_chunks", {}, len(self.documents)
+        if self.doc_vecs is not None:
+            yield "rag_index_vector_bytes", {}, int(self.doc_vecs.nbytes)
+        if self.bm25 is not None:
+            yield "rag_bm25_postings", {}, len(self.bm25.doc_ids)
+        yield "rag_shards_loaded", {}, len(self.shards)
+        yield "rag_shard_pool_bytes", {}, self.shards.bytes
+        for c in self._caches() + ([self.semantic_cache] if self.semantic_cache else []):
+            st = c.stats()
+            for field in ("size", "hits", "misses"):
+                yield f"rag_cache_{'entries' if field == 'size' else field}", {"cache": c.name}, st[field]
+        if self.scheduler is not None:
+            yield "rag_gen_queue_depth", {}, self.scheduler._q.qsize()
+        yield "rag_requests_in_flight", {}, self._pending
+        yield "rag_requests_rejected", {}, self.rejected
+        if self.prefix_cache is not None:
+            yield "rag_prefix_kv_hits", {}, self.prefix_cache.hits
+        if self._reranker is not None:
+            yield "rag_rerank_runs", {}, self._reranker.runs
+            yield "rag_rerank_fallbacks", {}, self._reranker.fallbacks
+
+    @property
+    def embedder(self) -> STEmbedder:
+        if self._embedder is None:
+            with self._embedder_lock:
+                if self._embedder is None:
+                    self._embedder = STEmbedder("sentence-transformers/all-MiniLM-L6-v2", device=config.DEVICE)
+        return self._embedder
+
+    @property
+    def reranker(self) -> CrossEncoderReranker:
+        if self._reranker is None:
+            with self._embedder_lock:
+                if self._reranker is None:
+                    self._reranker = CrossEncoderReranker(config.RERANK_MODEL, device=config.DEVICE)
+        return self._reranker
+
+    def _caches(self) -> List[LRUCache]:
+        return [c for c in (self.query_cache, self.answer_cache) if c is not None]
 
     def _ensure_lm_loaded(self):
-        if not self._model_loaded:
-            self.mm = SafeModelManager(config.MODEL_ID)
-            self.mm.load()
-            self._model_loaded = True
+        if self._model_loaded:
+            return
+        with self._lm_lock:
+            if not self._model_loaded:
+                self.mm = SafeModelManager(config.MODEL_ID)
+                self.mm.load()
+                if config.PREFIX_KV_CACHE:
+                    self.prefix_cache = PrefixKVCache(self.mm)
+                if config.GEN_BATCHING:
+                    self.scheduler = GenerationScheduler(self.mm, config.GEN_MAX_BATCH, config.GEN_BATCH_WAIT_MS,
+                                                         self.prefix_cache)
+                self._model_loaded = True
 
     # --------- Index build & load ----------
-    def _bundle_id_for(self, pdf_paths: List[str]) -> str:
-        digest = "|".join([_hash_file(p) for p in pdf_paths]) + \
-                 f"|{config.MAX_TOKENS_PER_CHUNK}|{config.CHUNK_OVERLAP_TOKENS}|{config.INDEX_NAME}"
+    # Each PDF is embedded into its own shard under CACHE_DIR/shards, keyed by the file's content
+    # hash plus everything that affects its chunks/vectors. --build only embeds PDFs without a
+    # shard, drops shards nobody references any more, and merges shards into the serving bundle.
+    def _shard_key(self, file_hash: str) -> str:
+        digest = f"{file_hash}|{config.MAX_TOKENS_PER_CHUNK}|{config.CHUNK_OVERLAP_TOKENS}|{config.LIMIT_PAGES}|{config.INDEX_NAME}"
         return hashlib.sha256(digest.encode()).hexdigest()[:16]
 
-    def build_index(self):
+    def _bundle_id_for(self, shards: List[Tuple[str, str]]) -> str:
+        digest = "|".join(f"{name}:{key}" for name, key in shards) + \
+                 f"|{config.MAX_CHUNKS}|{config.INDEX_NAME}|{config.INDEX_VEC_DTYPE}|{BUNDLE_FORMAT}" + \
+                 (f"|dedup:{config.DEDUP_JACCARD}" if config.DEDUP else "")
+        return hashlib.sha256(digest.encode()).hexdigest()[:16]
+
+    # Streaming ingestion: page ranges -> chunks -> EMB_BATCH_SIZE embedding batches -> append-only
+    # shard writer. Each new PDF becomes a shard directory (same raw layout as a bundle) under
+    # CACHE_DIR/shards. Peak memory is one embedding batch plus one page range, independent of
+    # corpus size. After roughly every batch, at a page-range boundary, the shard writer checkpoints;
+    # an interrupted --build resumes from the last checkpoint instead of starting the PDF over.
+    def _embed_new_pdfs(self, todo: List[Tuple[str, str, str]]) -> dict:
+        stats = {"pdfs": len(todo), "pages": 0, "chunks": 0, "extract_s": 0.0, "embed_s": 0.0}
+        ppt = max(1, config.PAGES_PER_TASK)
+        tasks, plan = [], {}
+        for path, name, shard_path in todo:
+            n_pages = pdf_page_count(path, config.LIMIT_PAGES)
+            n_ranges = (n_pages + ppt - 1) // ppt
+            ckpt = BundleWriter.read_checkpoint(shard_path) or {}
+            done = ckpt.get("ranges_done", 0) if ckpt.get("n_ranges") == n_ranges else 0
+            if done:
+                print(f"↩️ Resuming {name} at page {done * ppt + 1}/{n_pages} ({ckpt['n']} chunks already embedded)")
+            plan[path] = {"name": name, "shard": shard_path, "n_ranges": n_ranges, "done": done,
+                          "n_pages": ckpt.get("n_pages", 0) if done else 0, "writer": None, "pending": []}
+            stats["pages"] += n_pages - done * ppt
+            tasks += [ExtractTask(path, st, min(n_pages, st + ppt), config.MAX_TOKENS_PER_CHUNK,
+                                  config.CHUNK_OVERLAP_TOKENS, config.USE_PYMUPDF)
+                      for st in range(done * ppt, n_pages, ppt)]
+
+        def flush(p, upto: int):
+            # embed + append pending chunks in EMB_BATCH_SIZE batches while at least `upto` remain
+            while p["pending"] and len(p["pending"]) >= upto:
+                batch = p["pending"][:config.EMB_BATCH_SIZE]
+                del p["pending"][:config.EMB_BATCH_SIZE]
+                t0 = time.perf_counter()
+                vecs = self.embedder.embed_texts([c[2] for c in batch], batch_size=config.EMB_BATCH_SIZE)
+                stats["embed_s"] += time.perf_counter() - t0
+                p["writer"].append(vecs, [c[2] for c in batch], p["name"], [c[0] for c in batch], [c[1] for c in batch])
+                stats["chunks"] += len(batch)
+
+        def finish(p):
+            p["writer"] = p["writer"] or BundleWriter(p["shard"], "float32", resume=p["done"] > 0)
+            flush(p, 1)
+            p["writer"].close({"n_pages": p["n_pages"]})
+            print(f"🔮 Embedded {p['name']} ({p['writer'].n} chunks)")
+            p["writer"] = None
+
+        for p in plan.values():
+            if p["done"] == p["n_ranges"]:
+                finish(p)  # empty PDF, or interrupted right before the shard was finalised
+
+        for task, page_chunks, secs in iter_extract_chunks(tasks, config.N_WORKERS):
+            stats["extract_s"] += secs
+            p = plan[task.path]
+            if p["writer"] is None:
+                p["writer"] = BundleWriter(p["shard"], "float32", resume=p["done"] > 0)
+                p["since_ckpt"] = 0
+            for chunks in page_chunks:
+                p["pending"] += [(p["n_pages"], c_idx, ch) for c_idx, ch in enumerate(chunks)]
+                p["n_pages"] += 1
+            n_before = p["writer"].n
+            flush(p, config.EMB_BATCH_SIZE)
+            p["since_ckpt"] += p["writer"].n - n_before
+            p["done"] += 1
+            if p["done"] == p["n_ranges"]:
+                finish(p)
+            elif p["since_ckpt"] >= config.EMB_BATCH_SIZE or not p["pending"]:
+                flush(p, 1)
+                p["writer"].checkpoint(ranges_done=p["done"], n_ranges=p["n_ranges"], n_pages=p["n_pages"])
+                p["since_ckpt"] = 0
+        return stats
+
+    # tenant=None builds the shared base corpus from DATA_DIR; a user tenant builds their overlay
+    # from USER_DATA_DIR/<tenant>. Either way the result is published as that tenant's ref.
+    def build_index(self, tenant: Optional[str] = None, data_dir: Optional[str] = None):
+        tenant = tenant_key(tenant or config.BASE_TENANT)
+        if data_dir is None:
+            data_dir = config.DATA_DIR if tenant == tenant_key(config.BASE_TENANT) else os.path.join(config.USER_DATA_DIR, tenant)
+        with telemetry.span("build", tenant=tenant):
+            self._build_index(tenant, data_dir)
+
+    def _build_index(self, tenant: str, data_dir: str):
         os.makedirs(config.CACHE_DIR, exist_ok=True)
-        pdf_paths = sorted(glob.glob(os.path.join(config.DATA_DIR, "*.pdf")))
+        shard_dir = os.path.join(config.CACHE_DIR, "shards")
+        os.makedirs(shard_dir, exist_ok=True)
+        pdf_paths = sorted(glob.glob(os.path.join(data_dir, "*.pdf")))
         if not pdf_paths:
-            raise RuntimeError(f"No PDFs found in {config.DATA_DIR}")
-
-        bundle_id = self._bundle_id_for(pdf_paths)
-        out_npz  = os.path.join(config.CACHE_DIR, f"{bundle_id}.npz")
-        out_meta = os.path.join(config.CACHE_DIR, f"{bundle_id}.meta.json")
-
-        print(f"📚 Ingesting {len(pdf_paths)} PDFs from {config.DATA_DIR} ...")
-        all_chunks = []
-        for path in pdf_paths:
-            pages = extract_pdf_text_fast(path, config.LIMIT_PAGES)
-            for p_idx, txt in enumerate(pages):
-                chunks = create_chunks(txt, config.MAX_TOKENS_PER_CHUNK, config.CHUNK_OVERLAP_TOKENS)
-                for c_idx, ch in enumerate(chunks):
-                    all_chunks.append((os.path.basename(path), p_idx, c_idx, ch))
-
-        if config.FAST_MODE and config.MAX_CHUNKS and len(all_chunks) > config.MAX_CHUNKS:
-            all_chunks = all_chunks[:config.MAX_CHUNKS]
-
-        texts = [c[3] for c in all_chunks]
-        print(f"🔮 Embedding {len(texts)} chunks...")
+            raise RuntimeError(f"No PDFs found in {data_dir}")
+
+        shards = [(os.path.basename(p), self._shard_key(_hash_file(p))) for p in pdf_paths]
+        bundle_id = self._bundle_id_for(shards)
+        out_dir = os.path.join(config.CACHE_DIR, bundle_id)
+        out_meta = os.path.join(out_dir, "meta.json")
+
+        print(f"📚 Ingesting {len(pdf_paths)} PDFs from {data_dir} (tenant {tenant}) ...")
+        todo = []
+        for path, (name, key) in zip(pdf_paths, shards):
+            meta = os.path.join(shard_dir, key, "meta.json")
+            if os.path.exists(meta):
+                os.utime(meta)  # reused: keep it out of a concurrent build's stale sweep until we merge it
+            else:
+                todo.append((path, name, os.path.join(shard_dir, key)))
+        n_new = len(todo)
         t0 = time.time()
-        vecs = self.embedder.embed_texts(texts, batch_size=config.EMB_BATCH_SIZE)
-        print(f"✅ Embeddings ready in {time.time()-t0:.1f}s")
-
-        sources = np.array([c[0] for c in all_chunks], dtype=object)
-        pages   = np.array([c[1] for c in all_chunks], dtype=np.int32)
-        cids    = np.array([c[2] for c in all_chunks], dtype=np.int32)
-
-        np.savez_compressed(out_npz, vecs=vecs.astype("float32"),
-                            texts=np.array(texts, dtype=object),
-                            sources=sources, pages=pages, cids=cids)
-
-        meta = {
-            "bundle_id": bundle_id,
-            "pdfs": [os.path.basename(p) for p in pdf_paths],
-            "index_name": config.INDEX_NAME,
-            "chunk_tokens": config.MAX_TOKENS_PER_CHUNK,
-            "overlap": config.CHUNK_OVERLAP_TOKENS,
-            "n_chunks": len(texts)
-        }
-        with open(out_meta, "w") as f:
-            json.dump(meta, f, indent=2)
-
-        print("✅ Wrote index:", out_npz)
+        with telemetry.span("build.ingest", pdfs=n_new) as sp:
+            st = self._embed_new_pdfs(todo)
+            sp.set(pages=st["pages"], chunks=st["chunks"])
+        wall = time.time() - t0
+        telemetry.record("build.extract", st["extract_s"] * 1000, pages=st["pages"], workers=config.N_WORKERS)
+        telemetry.record("build.embed", st["embed_s"] * 1000, chunks=st["chunks"])
+        rate = lambda n, sec: f"{n / sec:.1f}/s" if sec > 0 else "-"
+        print(f"✅ {n_new} new/changed PDFs ({st['chunks']} chunks) embedded in {wall:.1f}s, "
+              f"{len(pdf_paths) - n_new} reused")
+        if n_new:
+            print(f"⏱️ extract+chunk: {st['pages']} pages, {st['extract_s']:.1f} worker-s ({rate(st['pages'], st['extract_s'])}/worker, "
+                  f"{config.N_WORKERS} workers) | embed: {st['chunks']} chunks in {st['embed_s']:.1f}s ({rate(st['chunks'], st['embed_s'])}) "
+                  f"| wall {rate(st['pages'], wall)} pages")
+
+        live = {key for _, key in shards}
+        keep = [ref for t, ref in index_refs().items() if t != tenant]  # shards behind other tenants' bundles stay
+        if tenant != tenant_key(config.BASE_TENANT) and read_index_ref(config.BASE_TENANT) is None:
+            keep.append(self._latest_index_path())  # base corpus built before tenant refs
+        for ref in keep:
+            if not ref or not os.path.isdir(ref):
+                continue
+            try:
+                with open(os.path.join(ref, "meta.json")) as f:
+                    live.update(json.load(f).get("shards", {}).values())
+            except (FileNotFoundError, ValueError):
+                pass
+        # Only finished shards nobody published and nobody touched for SHARD_GC_GRACE_S: *.tmp
+        # checkpoints belong to interrupted/running builds (resumable), and fresh or just-reused
+        # shards may be about to be merged by another tenant's build that hasn't published yet.
+        cutoff = time.time() - config.SHARD_GC_GRACE_S
+        for stale in glob.glob(os.path.join(shard_dir, "*")):
+            name = os.path.basename(stale)
+            meta = os.path.join(stale, "meta.json")
+            if name in live or name.endswith(".tmp") or not os.path.exists(meta) or os.path.getmtime(meta) > cutoff:
+                continue
+            shutil.rmtree(stale, ignore_errors=True)
+            print("🗑️ Dropped stale shard:", name)
+
+        if n_new == 0 and os.path.exists(out_meta):
+            self._prebuild_sidecars(out_dir)
+            write_index_ref(tenant, out_dir)
+            print("✅ Index up to date:", out_dir)
+            return
+
+        # merge shards (in PDF order) into the serving bundle, one block in memory at a time;
+        # duplicate chunks are folded into their first occurrence as provenance (the deduper's
+        # per-chunk state is the one part that grows with the corpus, see ChunkDeduper)
+        with telemetry.span("build.merge") as merge, tempfile.TemporaryDirectory(prefix="dedup-", dir=config.CACHE_DIR) as work_dir:
+            writer = BundleWriter(out_dir, config.INDEX_VEC_DTYPE)
+            limit = config.MAX_CHUNKS if (config.FAST_MODE and config.MAX_CHUNKS) else None
+            dedup = None
+            if config.DEDUP:
+                total = sum(len(open_bundle(os.path.join(shard_dir, key))[0]) for _, key in shards)
+                dedup = ChunkDeduper(config.DEDUP_JACCARD, total if limit is None else min(total, limit), work_dir)
+            step = max(1, config.EMB_BATCH_SIZE)
+            for name, key in shards:
+                if limit is not None and writer.n >= limit:
+                    break
+                store, vecs, _ = open_bundle(os.path.join(shard_dir, key))
+                take = len(store) if limit is None else min(len(store), limit - writer.n)
+                for i in range(0, take, step):
+                    j = min(take, i + step)
+                    texts = [store.text(r) for r in range(i, j)]
+                    keep = list(range(len(texts)))
+                    if dedup is not None:
+                        keep = []
+                        for n, text in enumerate(texts):
+                            row = dedup.check(text, writer.n + len(keep))
+                            if row is None:
+                                keep.append(n)
+                            else:
+                                writer.add_duplicate(row, name, store.pages[i + n], store.cids[i + n])
+                    writer.append(np.asarray(vecs[i:j])[keep], [texts[n] for n in keep], name,
+                                  np.asarray(store.pages[i:j])[keep], np.asarray(store.cids[i:j])[keep])
+            writer.close({
+                "bundle_id": bundle_id,
+                "pdfs": [os.path.basename(p) for p in pdf_paths],
+                "shards": dict(shards),
+                "index_name": config.INDEX_NAME,
+                "chunk_tokens": config.MAX_TOKENS_PER_CHUNK,
+                "overlap": config.CHUNK_OVERLAP_TOKENS,
+            })
+            merge.set(chunks=writer.n, duplicates=len(writer.dups))
+        if dedup is not None and writer.dups:
+            print(f"🧬 Dedup: {dedup.n_exact} exact + {dedup.n_near} near-duplicate chunks folded "
+                  f"({writer.n} unique of {writer.n + len(writer.dups)})")
+        self._prebuild_sidecars(out_dir)
+        write_index_ref(tenant, out_dir)  # publish only once the bundle and its sidecars are complete
+
+        print("✅ Wrote index:", out_dir)
         print("🧾 Meta:", out_meta)
 
+    # Derived per-bundle data; each loader is a no-op when its sidecar already exists
+    def _prebuild_sidecars(self, out_dir: str):
+        store, vecs, _ = open_bundle(out_dir)
+        with telemetry.span("build.vector_index"):
+            load_vector_index(vecs, out_dir)  # ANN lists / quantized codes (no-op for exact float search)
+        with telemetry.span("build.bm25"):
+            load_bm25_index(store, out_dir)
+        if config.PRETOKENIZE_CHUNKS and load_chunk_tokens(store, out_dir, config.MODEL_ID) is None:
+            try:
+                with telemetry.span("build.chunk_tokens"):
+                    load_chunk_tokens(store, out_dir, config.MODEL_ID, load_chunk_encoder(config.MODEL_ID))
+            except Exception as e:
+                print(f"⚠️ Skipping chunk token ids ({e})")
+
+    # Caches from before tenant refs existed: newest bundle by mtime, ignoring any bundle a
+    # tenant ref points at (a user overlay must never shadow the base corpus)
     def _latest_index_path(self) -> Optional[str]:
         os.makedirs(config.CACHE_DIR, exist_ok=True)
-        cand = sorted(glob.glob(os.path.join(config.CACHE_DIR, "*.npz")), key=os.path.getmtime, reverse=True)
-        return cand[0] if cand else None
+        owned = {os.path.abspath(p) for p in index_refs().values()}
+        cand = [(os.path.getmtime(m), os.path.dirname(m)) for m in glob.glob(os.path.join(config.CACHE_DIR, "*", "meta.json"))
+                if not m.endswith(".tmp" + os.sep + "meta.json")]
+        cand += [(os.path.getmtime(p), p) for p in glob.glob(os.path.join(config.CACHE_DIR, "*.npz"))
+                 if os.path.basename(p).count(".") == 1]  # legacy bundles; skip <bundle>.<kind>.npz sidecars
+        cand = [c for c in cand if os.path.abspath(c[1]) not in owned]
+        return max(cand)[1] if cand else None
 
     def load_prebuilt_index(self):
-        idx = self._latest_index_path()
+        idx = read_index_ref(config.BASE_TENANT) or self._latest_index_path()
         if not idx:
-            raise RuntimeError("No index .npz found. Run `python fast_rag.py --build` first.")
-        arr = np.load(idx, allow_pickle=True)
-        texts   = arr["texts"].tolist()
-        sources = arr["sources"].tolist()
-        pages   = arr["pages"].astype(int).tolist()
-        cids    = arr["cids"].astype(int).tolist()
-        vecs    = arr["vecs"].astype("float32")
-        self.documents = [Document(text=t, page=p, chunk_id=c, source=s) for t,p,c,s in zip(texts, pages, cids, sources)]
-        self.doc_vecs = vecs
-        print(f"🔁 Loaded index: {os.path.basename(idx)} ({len(self.documents)} chunks)")
+            raise RuntimeError("No index found. Run `python fast_rag.py --build` first.")
+        self.base = IndexShard(tenant_key(config.BASE_TENANT), idx)
+        self.shards.clear()
+        bundle_id = self.base.bundle_id
+        for c in self._caches() + ([self.semantic_cache] if self.semantic_cache else []):
+            # keys start with the base bundle id ("<base>+<overlay>" for user views); others are stale
+            c.prune(lambda k: k[0].partition("+")[0] == bundle_id)
+        print(f"🔁 Loaded index: {os.path.basename(idx)} ({len(self.documents)} chunks, {self.doc_vecs.dtype}, {self.vindex.kind} search)")
 
     # --------- Context packing & QA ----------
-    def _pack_context(self, hits: List[Tuple[Document, float]]) -> str:
+    def _chunk_ids(self, d: Document) -> List[int]:
+        shard = d.shard or self.base
+        key = (shard.path if shard else None, self.mm.model_id)
+        tokens = shard.tokens(self.mm.model_id) if shard is not None and d.row >= 0 else None
+        if tokens is not None:
+            return tokens[d.row]
+        ids = self._token_memo.get((key, d.text))
+        if ids is None:
+            ids = self.mm.tok.encode(d.text, add_special_tokens=False)
+            self._token_memo.put((key, d.text), ids)
+        return ids
+
+    # Token-exact packing: the prompt is assembled from token ids and never re-tokenized, so the
+    # budget is exact. Context gets whatever MAX_CONTEXT_TOKENS leaves after the system prompt and
+    # question; the last chunk that does not fit is clipped at a token boundary. A budget the
+    # system prompt alone fills is refused rather than silently dropping the question.
+    def _pack_context(self, question: str, hits: List[Tuple[Document, float]]) -> List[int]:
         self._ensure_lm_loaded()
         tok = self.mm.tok
-        assembled, used = [], 0
-        budget = max(512, config.MAX_CONTEXT_TOKENS - 400)
-        for d, _ in hits:
-            snippet = f"{d.text}\n"
-            tokens = len(tok.encode(snippet))
-            if used + tokens > budget:
-                clip_len = max(0, int((budget - used) * 4))  # rough char approximation
-                clip = snippet[:clip_len]
-                if clip:
-                    assembled.append(clip)
+        enc = lambda text: tok.encode(text, add_special_tokens=False)
+        head = tok.encode(f"<|system|>\n{system_preamble(route(question))}\n</|system|>\n<|context|>\n")
+        mid, end = enc("\n</|context|>\n<|user|>\n"), enc("\n</|user|>\n<|assistant|>")
+        room = config.MAX_CONTEXT_TOKENS - len(head) - len(mid) - len(end)
+        if room <= 0:
+            raise ValueError(f"MAX_CONTEXT_TOKENS={config.MAX_CONTEXT_TOKENS} leaves no room for the question "
+                             f"(system prompt and markers alone take {len(head) + len(mid) + len(end)} tokens)")
+        if self.prefix_cache is not None:
+            self.prefix_cache.add(head)
+        tail = mid + enc(question)[:room] + end  # an oversized question keeps its head; context goes first
+        budget = config.MAX_CONTEXT_TOKENS - len(head) - len(tail)
+        sep = enc("\n\n")
+        ids = list(head)
+        for n, (d, _) in enumerate(hits):
+            chunk = (sep if n else []) + self._chunk_ids(d)
+            if len(chunk) > budget:
+                ids += chunk[:max(0, budget)]
                 break
-            assembled.append(snippet)
-            used += tokens
-        return "\n".join(assembled)
-
-    def search(self, query: str):
-        qv = self.embedder.embed_text(query)
-        idx_scores = top_k_sim(qv, self.doc_vecs, config.TOP_K)
-        return [(self.documents[i], s) for i, s in idx_scores]
-
-    def answer(self, question: str) -> str:
-        hits = self.search(question)
-        if not hits or hits[0][1] < config.CONFIDENCE_THRESHOLD:
+            ids += chunk
+            budget -= len(chunk)
+        return ids + tail
+
+    def search(self, query: str, user: Optional[str] = None):
+        return self._retrieve(query, {}, user)[1]
+
+    # Shards a question from `user` searches: the base corpus, then their overlay if they have one
+    def _view(self, user: Optional[str]) -> List[IndexShard]:
+        view = [self.base]
+        if user and tenant_key(user) != self.base.tenant:
+            overlay = self.shards.get(user)
+            if overlay is not None:
+                view.append(overlay)
+        return view
+
+    def _hits(self, view: List[IndexShard], idx_scores: List[Tuple[int, int, float]]) -> List[Tuple[Document, float]]:
+        hits = []
+        for j, i, s in idx_scores:
+            d = view[j].documents[i]
+            d.shard = view[j]
+            hits.append((d, s))
+        return hits
+
+    # query -> (query vector, [(Document, score)], semantic-cache key), through the L1 query cache.
+    # Cached rows are (shard position in the view, row, score); the key names every bundle searched.
+    # A re-rank that fell back to bi-encoder order is not cached, so the next ask can still re-rank.
+    def _retrieve(self, query: str, timings: dict, user: Optional[str] = None):
+        view = self._view(user)
+        view_id = "+".join(sh.bundle_id for sh in view)
+        key = (view_id, normalize_query(query))
+        cached = self.query_cache.get(key) if self.query_cache is not None else None
+        if cached is None:
+            with telemetry.span("embed"):
+                qv = self.embedder.embed_text(query)
+            k = max(config.TOP_K, config.RERANK_CANDIDATES if config.RERANK else 0,
+                    config.MMR_CANDIDATES if config.MMR_LAMBDA < 1 else 0)
+            with telemetry.span("search", shards=len(view)):
+                idx_scores = self._search_view(view, qv, query, k)
+            reranked = True
+            if config.RERANK and len(idx_scores) > config.TOP_K:
+                idx_scores, reranked = self._rerank(query, view, idx_scores, timings)
+            if config.MMR_LAMBDA < 1 and len(idx_scores) > config.TOP_K:
+                idx_scores = self._diversify(view, idx_scores, config.TOP_K, config.MMR_LAMBDA)
+            idx_scores = idx_scores[:config.TOP_K]
+            if self.query_cache is not None and reranked:
+                self.query_cache.put(key, (qv, idx_scores))
+        else:
+            qv, idx_scores = cached
+        if self.query_cache is not None:
+            timings.setdefault("cache", {})["query"] = "miss" if cached is None else "hit"
+        return qv, self._hits(view, idx_scores), (view_id, qv, frozenset((j, i) for j, i, _ in idx_scores))
+
+    # Base + overlay: each shard's dense and BM25 candidates are merged by score into one ranking
+    # per side and fused once over (shard, row), so a question ranks the same with or without an
+    # overlay. Reported scores stay dense cosines.
+    def _search_view(self, view: List[IndexShard], qv: np.ndarray, query: str, k: int) -> List[Tuple[int, int, float]]:
+        if len(view) == 1:
+            return [(0, i, s) for i, s in view[0].search(qv, query, k)]
+        dense, sparse = [], []
+        for j, sh in enumerate(view):
+            d, sp = sh.rankings(qv, query, k)
+            dense += [((j, i), s) for i, s in d]
+            sparse += [((j, i), s) for i, s in sp]
+        dense.sort(key=lambda t: -t[1])
+        if not sparse:
+            return [(j, i, s) for (j, i), s in dense[:k]]
+        n = max(k, config.HYBRID_CANDIDATES)
+        dense, sparse = dense[:n], sorted(sparse, key=lambda t: -t[1])[:n]
+        keys = fuse_rankings(dense, sparse, k, config.HYBRID_SEARCH, config.RRF_K, config.HYBRID_DENSE_WEIGHT)
+        cos = dict(dense)
+        for j, sh in enumerate(view):
+            missing = [i for jj, i in keys if jj == j and (j, i) not in cos]
+            if missing:
+                cos.update(((j, i), c) for i, c in sh.cosines(qv, missing, {}).items())
+        return [(j, i, float(cos[(j, i)])) for j, i in keys]
+
+    def _vector_search(self, qv: np.ndarray, query: str, k: int) -> List[Tuple[int, float]]:
+        return self.base.search(qv, query, k)
+
+    # Candidate pool -> (pool in cross-encoder order, True), or (pool unchanged, False) when the
+    # latency budget ran out. Reported scores stay dense cosines, so hits[0] is the top re-ranked
+    # chunk, not the best cosine; the confidence gate in _canned_answer takes their max.
+    def _rerank(self, query: str, view: List[IndexShard], idx_scores: List[Tuple[int, int, float]], timings: dict):
+        with telemetry.span("rerank", timings, "rerank_ms", candidates=len(idx_scores)) as sp:
+            order = self.reranker.rank(query, [view[j].documents[i].text for j, i, _ in idx_scores],
+                                       [(view[j].bundle_id, i) for j, i, _ in idx_scores],
+                                       config.RERANK_BATCH_SIZE, config.RERANK_BUDGET_MS)
+            sp.set(fallback=order is None)
+        if order is None:
+            return idx_scores, False
+        return [idx_scores[n] for n in order], True
+
+    # MMR over the pool in its current (fused / re-ranked) order: relevance falls off linearly with
+    # rank, redundancy is the highest cosine to a chunk already picked. The top hit always stays,
+    # but later picks are by diversity, so the confidence gate looks at the best cosine, not hits[0].
+    def _diversify(self, view: List[IndexShard], idx_scores: List[Tuple[int, int, float]], k: int, lam: float):
+        n = len(idx_scores)
+        vecs = np.stack([np.asarray(view[j].doc_vecs[i], dtype=np.float32) for j, i, _ in idx_scores])
+        sim = vecs @ vecs.T
+        rel = 1.0 - np.arange(n) / n
+        picked, redundancy = [0], sim[0].copy()
+        while len(picked) < min(k, n):
+            mmr = lam * rel - (1 - lam) * redundancy
+            mmr[picked] = -np.inf
+            c = int(np.argmax(mmr))
+            picked.append(c)
+            redundancy = np.maximum(redundancy, sim[c])
+        return [idx_scores[c] for c in picked]
+
+    def answer(self, question: str, user: Optional[str] = None) -> str:
+        return self.ask(question, user)["answer"]
+
+    # answer + the hits it was grounded on + per-stage timings (ms). Past timeout_s generation is
+    # stopped and TimeoutError raised.
+    def ask(self, question: str, user: Optional[str] = None, timeout_s: Optional[float] = None) -> dict:
+        timings = {}
+        deadline = time.perf_counter() + timeout_s if timeout_s else None
+        with telemetry.span("answer", timings, "total_ms") as root:
+            with telemetry.span("retrieve", timings, "search_ms"):
+                _, hits, sem = self._retrieve(question, timings, user)
+            text = self._answer_from_hits(question, hits, timings, sem, deadline)
+            if telemetry.enabled:
+                root.set(domain=route(question), hits=len(hits), cache=timings.get("cache"))
+        return self._result(question, text, hits, timings)
+
+    # Streaming variant of ask(): yields {"delta": str} events as text is generated, then one
+    # final {"done": True, "answer", "hits", "timings", ...} event. Each event is JSON-ready,
+    # so it maps 1:1 onto NDJSON lines or SSE "data:" frames.
+    # Past timeout_s generation stops and TimeoutError is raised after the text streamed so far.
+    def stream_ask(self, question: str, user: Optional[str] = None, timeout_s: Optional[float] = None):
+        deadline = time.perf_counter() + timeout_s if timeout_s else None
+        with telemetry.span("answer", stream=True) as root:
+            yield from self._stream_ask(question, root, user, deadline)
+
+    def _stream_ask(self, question: str, root, user: Optional[str] = None, deadline: Optional[float] = None):
+        timings = {}
+        t0 = time.perf_counter()
+        with telemetry.span("retrieve", timings, "search_ms"):
+            _, hits, sem = self._retrieve(question, timings, user)
+        canned = self._canned_answer(question, hits, timings, sem)
+        if canned is not None:
+            text = canned
+            yield {"delta": text}
+        else:
+            parts = []
+            for piece in self._generate_stream(self._build_prompt(question, hits, timings), timings, deadline):
+                parts.append(piece)
+                yield {"delta": piece}
+            text = trim_stops("".join(parts))
+            if text:
+                self._remember(sem, text)
+            else:
+                text = "I don't know."
+                yield {"delta": text}
+        timings["total_ms"] = (time.perf_counter() - t0) * 1000
+        if telemetry.enabled:
+            root.set(domain=route(question), hits=len(hits), cache=timings.get("cache"))
+        yield {"done": True, **self._result(question, text, hits, timings)}
+
+    def stream_answer(self, question: str, user: Optional[str] = None):
+        for ev in self.stream_ask(question, user):
+            if "delta" in ev:
+                yield ev["delta"]
+
+    # --------- asyncio API ----------
+    # Embedding + search run on a RETRIEVE_WORKERS thread pool, generation on the scheduler thread
+    # (a dedicated batch-of-one worker without GEN_BATCHING), so the event loop never blocks.
+    # At most MAX_PENDING_REQUESTS questions are in flight (Overloaded beyond that); past
+    # timeout_s, or when the awaiting task is cancelled, generation stops at the next token.
+    async def aanswer(self, question: str, user: Optional[str] = None, timeout_s: Optional[float] = None) -> str:
+        return (await self.aask(question, user, timeout_s))["answer"]
+
+    async def aask(self, question: str, user: Optional[str] = None, timeout_s: Optional[float] = None) -> dict:
+        cancel = threading.Event()
+        deadline = time.perf_counter() + timeout_s if timeout_s else None
+        with self._admit():
+            try:
+                return await asyncio.wait_for(self._aask(question, user, cancel, deadline), timeout_s)
+            except asyncio.TimeoutError:
+                raise TimeoutError(f"no answer within {timeout_s}s") from None
+            finally:
+                cancel.set()  # no-op once answered; otherwise drops/stops the queued generation
+
+    async def _aask(self, question: str, user: Optional[str], cancel: threading.Event,
+                    deadline: Optional[float]) -> dict:
+        loop = asyncio.get_running_loop()
+        timings = {}
+        t0 = time.perf_counter()
+        hits, sem, canned, prompt = await loop.run_in_executor(self._retrieve_pool(), self._prepare,
+                                                               question, user, timings)
+        text = canned
+        if text is None:
+            text = self._cached_answer(prompt, timings)
+        if text is None:
+            text = await self._agenerate(prompt, timings, cancel, deadline)
+            self._remember(sem, text)
+        timings["total_ms"] = (time.perf_counter() - t0) * 1000
+        telemetry.record("answer", timings["total_ms"], domain=route(question), hits=len(hits),
+                         cache=timings.get("cache"), aio=True)
+        return self._result(question, text, hits, timings)
+
+    # Runs on the retrieval pool: everything up to the prompt ids (None when no generation is needed)
+    def _prepare(self, question: str, user: Optional[str], timings: dict):
+        with telemetry.span("retrieve", timings, "search_ms"):
+            _, hits, sem = self._retrieve(question, timings, user)
+        canned = self._canned_answer(question, hits, timings, sem)
+        prompt = self._build_prompt(question, hits, timings) if canned is None else None
+        return hits, sem, canned, prompt
+
+    async def _agenerate(self, prompt: List[int], timings: dict, cancel: threading.Event,
+                         deadline: Optional[float]) -> str:
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        def on_done(r):
+            loop.call_soon_threadsafe(lambda: fut.done() or fut.set_result(r))
+        req = self._gen_worker_for_async().enqueue(prompt, cancel, deadline, on_done)
+        await fut
+        if req.error is not None:
+            raise req.error
+        return self._scheduled_answer(prompt, req, timings)
+
+    def _gen_worker_for_async(self) -> GenerationScheduler:
+        self._ensure_lm_loaded()
+        if self.scheduler is not None:
+            return self.scheduler
+        with self._pending_lock:
+            if self._gen_worker is None:
+                self._gen_worker = GenerationScheduler(self.mm, 1, 0, self.prefix_cache, lock=self._lm_lock)
+            return self._gen_worker
+
+    def _retrieve_pool(self) -> ThreadPoolExecutor:
+        with self._pending_lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(config.RETRIEVE_WORKERS, thread_name_prefix="rag-retrieve")
+            return self._executor
+
+    # Bounded admission shared by the async API and the server: raises Overloaded when full
+    @contextmanager
+    def _admit(self):
+        with self._pending_lock:
+            if self._pending >= config.MAX_PENDING_REQUESTS:
+                self.rejected += 1
+                raise Overloaded(f"{self._pending} requests already in flight")
+            self._pending += 1
+        try:
+            yield
+        finally:
+            with self._pending_lock:
+                self._pending -= 1
+
+    def _result(self, question: str, text: str, hits: List[Tuple[Document, float]], timings: dict) -> dict:
+        cache = timings.pop("cache", {})
+        return {
+            "answer": text,
+            "domain": route(question),
+            "hits": [{"source": d.source, "page": d.page, "chunk_id": d.chunk_id, "score": s,
+                      **({"also": [{"source": src, "page": p, "chunk_id": c} for src, p, c in d.also]} if d.also else {})}
+                     for d, s in hits],
+            "timings": {k: round(v, 2) for k, v in timings.items()},
+            "cache": cache,
+        }
+
+    # sem = (view id, query vector, retrieved rows): the semantic-cache key for this question
+    def _answer_from_hits(self, question: str, hits: List[Tuple[Document, float]], timings: dict, sem=None,
+                          deadline: Optional[float] = None) -> str:
+        canned = self._canned_answer(question, hits, timings, sem)
+        if canned is not None:
+            return canned
+        text = self._generate(self._build_prompt(question, hits, timings), timings, deadline=deadline)
+        self._remember(sem, text)
+        return text
+
+    def _remember(self, sem, text: str):
+        if self.semantic_cache is not None and sem is not None and text and text != "I don't know.":
+            self.semantic_cache.add(*sem, text)
+
+    # Answers that need no generation: low-confidence fallback (no hit's dense cosine reaches the
+    # threshold; hits stay in fused order for the context), a semantic-cache hit for a
+    # near-duplicate question, or (if enabled) the legacy keyword templates
+    def _canned_answer(self, question: str, hits: List[Tuple[Document, float]], timings: dict, sem=None) -> Optional[str]:
+        if not hits or max(s for _, s in hits) < config.CONFIDENCE_THRESHOLD:
             return "[Thinking: No relevant information found in knowledge base.] I don't have specific information about that in my knowledge base."
 
-        domain = route(question)
-        context = self._pack_context(hits)
-        
-        # Fast template-based responses for common questions
+        if self.semantic_cache is not None and sem is not None:
+            text = self.semantic_cache.lookup(*sem)
+            timings.setdefault("cache", {})["semantic"] = "miss" if text is None else "hit"
+            if text is not None:
+                return text
+
+        if not config.USE_KEYWORD_TEMPLATES:
+            return None
         question_lower = question.lower()
         
         if "credit score" in question_lower:
@@ -470,73 +3017,644 @@ class SimplePDFRAG:
         
         if "compound interest" in question_lower or "investing" in question_lower or "investment" in question_lower:
             return "[Thinking: Analyzing compound interest and investment strategies from financial documents...] Compound interest is the process where interest earned on an investment is added to the principal, and then earns interest itself. This creates exponential growth over time. The key factors are the interest rate, time period, and frequency of compounding. Starting early gives you the advantage of time, which is the most powerful factor in compound interest. The rule of 72 helps estimate how long it takes to double your money: divide 72 by your annual interest rate. At 6% annual returns, your money doubles every 12 years. This demonstrates the power of compound interest and why starting early is crucial for building wealth."
+        return None
 
-        # Use LLM for other questions
-        sys_msg = system_preamble(domain)
+    # -> exact prompt token ids, fed straight to generate() (and the answer-cache key)
+    def _build_prompt(self, question: str, hits: List[Tuple[Document, float]], timings: dict) -> List[int]:
         self._ensure_lm_loaded()
-
-        prompt = (
-            f"<|system|>\n{sys_msg}\n</|system|>\n"
-            f"<|context|>\n{context}\n</|context|>\n"
-            f"<|user|>\n{question}\n</|user|>\n"
-            f"<|assistant|>"
-        )
+        with telemetry.span("pack", timings, "pack_ms") as sp:
+            ids = self._pack_context(question, hits)
+            sp.set(prompt_tokens=len(ids))
+        timings["prompt_tokens"] = len(ids)
+        telemetry.observe("rag_prompt_tokens", len(ids), MetricsRegistry.TOKEN_BUCKETS)
+        return ids
+
+    def _cached_answer(self, prompt: List[int], timings: dict) -> Optional[str]:
+        if self.answer_cache is None:
+            return None
+        text = self.answer_cache.get((self.bundle_id, self.mm.model_id, tuple(prompt)))
+        timings.setdefault("cache", {})["answer"] = "miss" if text is None else "hit"
+        return text
+
+    def _store_answer(self, prompt: List[int], text: str):
+        if self.answer_cache is not None and text:
+            self.answer_cache.put((self.bundle_id, self.mm.model_id, tuple(prompt)), text)
+
+    # Time to first token (a 1-token generate) for one question per domain, prompt processed from
+    # scratch vs resumed from the cached system prefix
+    def bench_prefix(self, repeats: int = 5) -> dict:
+        self._ensure_lm_loaded()
+        if self.prefix_cache is None:
+            raise RuntimeError("PREFIX_KV_CACHE is off")
+        questions = ["How do I pay for college textbooks?", "Which debt should I pay off first?",
+                     "Should I open a Roth IRA?", "How do I make a monthly budget?", "What is an emergency fund?"]
+        model, tok = self.mm.model, self.mm.tok
+        kw = dict(generation_kwargs(tok), max_new_tokens=1, do_sample=False)
+        kw.pop("temperature"); kw.pop("top_p")
+        cold, warm, n_prompt, n_prefix = [], [], [], []
+        for q in questions:
+            prompt = self._build_prompt(q, self._retrieve(q, {})[1], {})
+            input_ids = torch.tensor([prompt], dtype=torch.long, device=model.device)
+            self.prefix_cache.lookup(prompt)  # warm this domain's prefix outside the timed runs
+            for _ in range(repeats):
+                with torch.no_grad():
+                    t0 = time.perf_counter()
+                    model.generate(input_ids=input_ids, attention_mask=torch.ones_like(input_ids), **kw)
+                    cold.append((time.perf_counter() - t0) * 1000)
+                    timings = {}
+                    t0 = time.perf_counter()
+                    model.generate(input_ids=input_ids, attention_mask=torch.ones_like(input_ids),
+                                   **self._prefix_kwargs(prompt, timings), **kw)
+                    warm.append((time.perf_counter() - t0) * 1000)
+            n_prompt.append(len(prompt))
+            n_prefix.append(timings.get("prefix_tokens", 0))
+        ms = lambda xs: {"p50": round(float(np.percentile(xs, 50)), 2), "mean": round(float(np.mean(xs)), 2)}
+        return {"model": self.mm.model_id, "device": str(model.device), "runs": len(cold),
+                "prompt_tokens": round(float(np.mean(n_prompt)), 1), "prefix_tokens": round(float(np.mean(n_prefix)), 1),
+                "ttft_ms": {"full_prompt": ms(cold), "prefix_cached": ms(warm)},
+                "speedup": round(float(np.mean(cold) / max(np.mean(warm), 1e-9)), 2)}
+
+    def _generation_stats(self, timings: dict, new_tokens: int, ms: float) -> dict:
+        timings["new_tokens"] = new_tokens
+        rate = new_tokens / max(ms / 1000, 1e-9)
+        if telemetry.enabled:
+            telemetry.observe("rag_generated_tokens", new_tokens, MetricsRegistry.TOKEN_BUCKETS)
+            telemetry.observe("rag_generation_tokens_per_second", rate, MetricsRegistry.RATE_BUCKETS)
+        return {"new_tokens": new_tokens, "tokens_per_s": round(rate, 2)}
+
+    # Resume from the cached KV of the prompt's system prefix, if any
+    def _prefix_kwargs(self, prompt: List[int], timings: dict) -> dict:
+        if self.prefix_cache is None:
+            return {}
+        timings["prefix_tokens"], past = self.prefix_cache.lookup(prompt)
+        return {"past_key_values": past} if past is not None else {}
+
+    def _generate(self, prompt: List[int], timings: dict, cancel: Optional[threading.Event] = None,
+                  deadline: Optional[float] = None) -> str:
+        cached = self._cached_answer(prompt, timings)
+        if cached is not None:
+            return cached
+
+        if self.scheduler is not None:
+            return self._scheduled_answer(prompt, self.scheduler.submit(prompt, cancel, deadline), timings)
 
         tok = self.mm.tok
         model = self.mm.model
-        enc = tok(prompt, return_tensors="pt", truncation=True, max_length=config.MAX_CONTEXT_TOKENS)
-        input_ids = enc["input_ids"].to(model.device)
-        attention_mask = enc.get("attention_mask", torch.ones_like(input_ids)).to(model.device)
-
-        with torch.no_grad():
-            gen = model.generate(
-                input_ids=input_ids,
-                attention_mask=attention_mask,
-                max_new_tokens=config.MAX_NEW_TOKENS,
-                do_sample=True,
-                temperature=config.TEMPERATURE,
-                top_p=config.TOP_P,
-                repetition_penalty=config.REPETITION_PENALTY,
-                pad_token_id=getattr(tok, "eos_token_id", tok.pad_token_id),
-                eos_token_id=getattr(tok, "eos_token_id", tok.pad_token_id)
-            )
+        input_ids = torch.tensor([prompt], dtype=torch.long, device=model.device)
+        attention_mask = torch.ones_like(input_ids)
+
+        req = _GenRequest(prompt, cancel, deadline)
+        t0 = time.perf_counter()
+        with self._lm_lock, torch.no_grad():
+            gen = model.generate(input_ids=input_ids, attention_mask=attention_mask,
+                                 stopping_criteria=transformers.StoppingCriteriaList([RequestStop([req])]),
+                                 **self._prefix_kwargs(prompt, timings), **generation_kwargs(tok))
+        timings["generate_ms"] = (time.perf_counter() - t0) * 1000
+        req.fail_if_expired()
+        if req.error is not None:
+            raise req.error
 
         new_tokens = gen[0, input_ids.shape[1]:]
-        text = tok.decode(new_tokens, skip_special_tokens=True).strip()
-        for stop in ["<|user|>", "<|system|>", "<|context|>"]:
-            if stop in text:
-                text = text.split(stop)[0].strip()
+        telemetry.record("generate", timings["generate_ms"], prompt_tokens=len(prompt),
+                         **self._generation_stats(timings, len(new_tokens), timings["generate_ms"]))
+
+        text = trim_stops(tok.decode(new_tokens, skip_special_tokens=True))
+        self._store_answer(prompt, text)
         return text if text else "I don't know."
 
+    def _scheduled_answer(self, prompt: List[int], req: _GenRequest, timings: dict) -> str:
+        timings["generate_ms"] = req.gen_ms
+        timings["queue_ms"] = (time.perf_counter() - req.t_submit) * 1000 - req.gen_ms
+        timings["batch_size"] = req.batch_size
+        timings["prefix_tokens"] = req.prefix_tokens
+        telemetry.record("generate", req.gen_ms, batch_size=req.batch_size, queue_ms=round(timings["queue_ms"], 3),
+                         prompt_tokens=len(prompt), **self._generation_stats(timings, req.new_tokens, req.gen_ms))
+        self._store_answer(prompt, req.text)
+        return req.text or "I don't know."
+
+    def _generate_stream(self, prompt: List[int], timings: dict, deadline: Optional[float] = None):
+        cached = self._cached_answer(prompt, timings)
+        if cached is not None:
+            yield cached
+            return
+
+        tok = self.mm.tok
+        model = self.mm.model
+        input_ids = torch.tensor([prompt], dtype=torch.long, device=model.device)
+        attention_mask = torch.ones_like(input_ids)
+
+        stop = threading.Event()
+        req = _GenRequest(prompt, stop, deadline)
+        streamer = transformers.TextIteratorStreamer(tok, skip_prompt=True, skip_special_tokens=True)
+        errors = []
+
+        def _run():
+            try:
+                with self._lm_lock, torch.no_grad():
+                    model.generate(input_ids=input_ids, attention_mask=attention_mask, streamer=streamer,
+                                   stopping_criteria=transformers.StoppingCriteriaList([RequestStop([req])]),
+                                   **self._prefix_kwargs(prompt, timings), **generation_kwargs(tok))
+            except Exception as e:
+                errors.append(e)
+                streamer.end()
+
+        t0 = time.perf_counter()
+        worker = threading.Thread(target=_run, name="gen-stream", daemon=True)
+        worker.start()
+        markers = StopMarkerFilter()
+        parts = []
+        try:
+            for piece in streamer:
+                if "ttft_ms" not in timings:
+                    timings["ttft_ms"] = (time.perf_counter() - t0) * 1000
+                out = markers.feed(piece)
+                if out:
+                    parts.append(out)
+                    yield out
+                if markers.stopped:
+                    break  # marker seen: end generation early instead of running to MAX_NEW_TOKENS
+            else:
+                if req.expired():
+                    raise TimeoutError("request deadline passed")  # stopped mid-answer: not cached
+                out = markers.flush()
+                if out:
+                    parts.append(out)
+                    yield out
+        finally:
+            stop.set()
+            worker.join()
+            timings["generate_ms"] = (time.perf_counter() - t0) * 1000
+            if telemetry.enabled:
+                n_new = len(tok.encode("".join(parts), add_special_tokens=False))
+                telemetry.record("generate", timings["generate_ms"], stream=True, prompt_tokens=len(prompt),
+                                 ttft_ms=round(timings.get("ttft_ms", 0.0), 3),
+                                 **self._generation_stats(timings, n_new, timings["generate_ms"]))
+                if "ttft_ms" in timings:
+                    telemetry.observe("rag_ttft_ms", timings["ttft_ms"])
+        if errors:
+            raise errors[0]
+        self._store_answer(prompt, trim_stops("".join(parts)))  # only reached if the consumer read to the end
+
     def cleanup(self):
+        if config.CACHE_PERSIST_PATH and self._caches():
+            save_caches(config.CACHE_PERSIST_PATH, self._caches())
+        if self._executor: self._executor.shutdown(wait=False)
         if self.mm: self.mm.cleanup()
 
 
+# ---------------- Server (warm process) ----------------
+# One long-lived SimplePDFRAG behind a tiny JSON-over-HTTP protocol:
+#   GET  /health  -> {"status": "ok"|"loading"|"error", "ready": bool, ...}   (503 until ready)
+#   GET  /stats   -> generation scheduler counters (batch occupancy, latency percentiles), cache hit rates, shard pool
+#   GET  /metrics -> Prometheus text (span latencies, token histograms, gauges) when TELEMETRY has "prometheus"
+#   POST /ask     -> {"question": "..."}  =>  {"answer", "domain", "hits": [...], "timings": {...}}
+#                    {"question": "...", "user_id": "..."} (or an x-user-id header) also searches that user's overlay
+#                    {"question": "...", "stream": true}  =>  NDJSON events (SSE if Accept: text/event-stream)
+#                    {"question": "...", "timeout_s": 10}   =>  504 past the deadline (default REQUEST_TIMEOUT_S);
+#                                                              a stream ends with an {"error": "timeout"} event instead
+#                    429 once MAX_PENDING_REQUESTS questions are in flight
+class RAGServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, addr, rag: SimplePDFRAG):
+        super().__init__(addr, RAGRequestHandler)
+        self.rag = rag
+        self.ready = False
+        self.error: Optional[str] = None
+        self.started = time.time()
+
+    def warm_up(self):
+        try:
+            self.rag.load_prebuilt_index()
+            if config.RERANK:
+                self.rag.reranker
+            self.rag._ensure_lm_loaded()
+            self.ready = True
+            print("✅ Server ready")
+        except Exception as e:
+            self.error = str(e)
+            print("❌ Warm-up failed:", e)
+
+class RAGRequestHandler(BaseHTTPRequestHandler):
+    server: RAGServer
+
+    def _send_json(self, status: int, payload: dict):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_text(self, status: int, text: str, content_type: str = "text/plain; version=0.0.4"):
+        body = text.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, fmt, *args):
+        print(f"[serve] {self.address_string()} {fmt % args}")
+
+    def do_GET(self):
+        srv, rag = self.server, self.server.rag
+        if self.path.rstrip("/") == "/metrics":
+            if not telemetry.prometheus:
+                return self._send_json(404, {"error": "metrics are off (set TELEMETRY to include \"prometheus\")"})
+            return self._send_text(200, telemetry.metrics.render())
+        if self.path.rstrip("/") == "/stats":
+            caches = rag._caches() + ([rag.semantic_cache] if rag.semantic_cache else [])
+            return self._send_json(200, {"scheduler": rag.scheduler.stats() if rag.scheduler else None,
+                                         "caches": {c.name: c.stats() for c in caches},
+                                         "prefix_kv": rag.prefix_cache.stats() if rag.prefix_cache else None,
+                                         "shards": rag.shards.stats(),
+                                         "rerank": rag._reranker.stats() if rag._reranker else None,
+                                         "requests": {"pending": rag._pending, "rejected": rag.rejected,
+                                                      "max_pending": config.MAX_PENDING_REQUESTS}})
+        if self.path.rstrip("/") not in ("/health", "/ready"):
+            return self._send_json(404, {"error": "not found"})
+        status = "ok" if srv.ready else ("error" if srv.error else "loading")
+        self._send_json(200 if srv.ready else 503, {
+            "status": status,
+            "ready": srv.ready,
+            "error": srv.error,
+            "model_id": rag.mm.model_id if rag.mm else None,
+            "model_loaded": rag._model_loaded,
+            "n_chunks": len(rag.documents),
+            "uptime_s": round(time.time() - srv.started, 1),
+        })
+
+    def do_POST(self):
+        if self.path.rstrip("/") != "/ask":
+            return self._send_json(404, {"error": "not found"})
+        if not self.server.ready:
+            return self._send_json(503, {"error": self.server.error or "server is still loading"})
+        try:
+            n = int(self.headers.get("Content-Length") or 0)
+            req = json.loads(self.rfile.read(n) or b"{}")
+        except Exception:
+            return self._send_json(400, {"error": "invalid JSON body"})
+        question = str(req.get("question") or "").strip()
+        if not question:
+            return self._send_json(400, {"error": "question is required"})
+        user = str(req.get("user_id") or self.headers.get("x-user-id") or "").strip() or None
+        try:
+            timeout_s = float(req.get("timeout_s") or config.REQUEST_TIMEOUT_S) or None
+        except (TypeError, ValueError):
+            return self._send_json(400, {"error": "timeout_s must be a number"})
+        try:
+            with self.server.rag._admit():
+                if req.get("stream"):
+                    return self._stream(question, user, timeout_s,
+                                        sse="text/event-stream" in (self.headers.get("Accept") or ""))
+                result = self.server.rag.ask(question, user, timeout_s)
+        except Overloaded as e:
+            return self._send_json(429, {"error": str(e)})
+        except TimeoutError as e:
+            return self._send_json(504, {"error": str(e) or "request timed out"})
+        except Exception as e:
+            return self._send_json(500, {"error": str(e)})
+        self._send_json(200, result)
+
+    # HTTP/1.0 response without Content-Length: one event per line/frame, connection close ends it
+    def _stream(self, question: str, user: Optional[str], timeout_s: Optional[float], sse: bool):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream" if sse else "application/x-ndjson")
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        events = self.server.rag.stream_ask(question, user, timeout_s)
+        try:
+            for ev in events:
+                line = json.dumps(ev)
+                self.wfile.write((f"data: {line}\n\n" if sse else f"{line}\n").encode("utf-8"))
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # client went away; closing the generator below stops generation
+        except Exception as e:
+            line = json.dumps({"error": "timeout" if isinstance(e, TimeoutError) else str(e)})
+            self.wfile.write((f"data: {line}\n\n" if sse else f"{line}\n").encode("utf-8"))
+        finally:
+            events.close()
+
+def serve(rag: SimplePDFRAG, host: str, port: int):
+    srv = RAGServer((host, port), rag)
+    # Listen first so /health can report "loading" while the index + LM warm up
+    threading.Thread(target=srv.warm_up, daemon=True).start()
+    print(f"🌐 Serving on http://{host}:{port} (GET /health, GET /stats, GET /metrics, POST /ask)")
+    try:
+        srv.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        srv.server_close()
+        rag.cleanup()
+
+
+# ---------------- Benchmarks ----------------
+# --bench: latency percentiles and throughput per pipeline stage over a fixed query set, at
+# several concurrency levels, on the prebuilt index and on synthetic corpora scaled to N
+# chunks (retrieval stages only; packing and generation do not depend on corpus size).
+# Caches are bypassed so every call does the real work. Results are written as JSON.
+BENCH_QUESTIONS = [
+    "How do I build a monthly budget?",
+    "What is the 50/30/20 rule?",
+    "How much should I keep in an emergency fund?",
+    "Should I pay off debt or invest first?",
+    "What is the debt avalanche method?",
+    "How does compound interest work?",
+    "What is a Roth IRA?",
+    "How much should I contribute to my 401k?",
+    "How do credit scores work?",
+    "How can I lower my credit card APR?",
+    "How do student loans work?",
+    "How can a college student save money on textbooks?",
+    "What is an index fund?",
+    "How do I start investing with little money?",
+    "What is dollar-cost averaging?",
+    "How do I avoid overdraft fees?",
+]
+
+def _latency_stats(lat_ms: List[float], wall_s: float) -> dict:
+    a = np.asarray(lat_ms, dtype=np.float64)
+    pct = lambda p: round(float(np.percentile(a, p)), 3)
+    return {"n": int(len(a)), "p50_ms": pct(50), "p95_ms": pct(95), "p99_ms": pct(99),
+            "mean_ms": round(float(a.mean()), 3), "throughput_per_s": round(len(a) / max(wall_s, 1e-9), 2)}
+
+def _bench_stage(fn, inputs: list, concurrency: int) -> dict:
+    def one(x):
+        t0 = time.perf_counter()
+        fn(x)
+        return (time.perf_counter() - t0) * 1000
+    fn(inputs[0])  # warm-up (first embed / generate pays one-off costs)
+    t0 = time.perf_counter()
+    if concurrency <= 1:
+        lat = [one(x) for x in inputs]
+    else:
+        with ThreadPoolExecutor(max_workers=concurrency) as ex:
+            lat = list(ex.map(one, inputs))
+    return _latency_stats(lat, time.perf_counter() - t0)
+
+# N unit vectors around the real ones (tiled + jitter), so cluster structure stays realistic
+def synthetic_corpus(base: np.ndarray, n: int, noise: float = 0.05, seed: int = 0) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    out = np.empty((n, base.shape[1]), dtype=np.dtype(config.INDEX_VEC_DTYPE))
+    for i in range(0, n, 65536):
+        j = min(n, i + 65536)
+        x = np.asarray(base[rng.integers(0, len(base), j - i)], dtype=np.float32)
+        x += rng.normal(scale=noise, size=x.shape).astype(np.float32)
+        out[i:j] = x / np.linalg.norm(x, axis=1, keepdims=True)
+    return out
+
+def run_benchmarks(rag: SimplePDFRAG, concurrency=(1, 4), corpus_sizes=(), repeat: int = 1,
+                   generation: bool = True) -> dict:
+    questions = BENCH_QUESTIONS * max(1, repeat)
+    k = config.TOP_K
+    saved = (rag.query_cache, rag.answer_cache, rag.semantic_cache)
+    rag.query_cache = rag.answer_cache = rag.semantic_cache = None
+    try:
+        qvs = {q: rag.embedder.embed_text(q) for q in BENCH_QUESTIONS}
+        stages = {
+            "embed_text": lambda q: rag.embedder.embed_text(q),
+            "top_k_sim": lambda q: top_k_sim(qvs[q], rag.doc_vecs, k),
+            "search": lambda q: rag._vector_search(qvs[q], q, k),
+        }
+        if config.RERANK:  # uncached: every call scores its whole candidate pool
+            pool = {q: [(0, i, s) for i, s in rag._vector_search(qvs[q], q, max(k, config.RERANK_CANDIDATES))]
+                    for q in BENCH_QUESTIONS}
+            stages["rerank"] = lambda q: (rag.reranker.cache.clear(), rag._rerank(q, [rag.base], pool[q], {}))
+        if generation:
+            rag._ensure_lm_loaded()
+            hits = {q: rag._hits([rag.base], [(0, i, s) for i, s in rag._vector_search(qvs[q], q, k)])
+                    for q in BENCH_QUESTIONS}
+            prompts = {q: rag._build_prompt(q, hits[q], {}) for q in BENCH_QUESTIONS}
+            stages["pack_context"] = lambda q: rag._pack_context(q, hits[q])
+            stages["generate"] = lambda q: rag._generate(prompts[q], {})
+            stages["answer"] = lambda q: rag.answer(q)
+        report = {
+            "meta": {"timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"), "bundle": rag.bundle_id,
+                     "n_chunks": len(rag.documents), "device": config.DEVICE,
+                     "model": rag.mm.model_id if rag.mm else config.MODEL_ID,
+                     "index": rag.vindex.kind, "hybrid": config.HYBRID_SEARCH, "top_k": k,
+                     "rerank": config.RERANK and {"model": config.RERANK_MODEL, "candidates": config.RERANK_CANDIDATES,
+                                                  "budget_ms": config.RERANK_BUDGET_MS},
+                     "vec_dtype": str(rag.doc_vecs.dtype), "quantization": config.INDEX_QUANTIZATION,
+                     "gen_batching": config.GEN_BATCHING, "queries": len(questions)},
+            "stages": {},
+            "synthetic": [],
+        }
+        for name, fn in stages.items():
+            report["stages"][name] = {str(c): _bench_stage(fn, questions, c) for c in concurrency}
+            print(f"⏱️ {name}: " + ", ".join(f"c={c} p50 {r['p50_ms']:.1f}ms p99 {r['p99_ms']:.1f}ms {r['throughput_per_s']}/s"
+                                           for c, r in report["stages"][name].items()))
+        for n in corpus_sizes:
+            vecs = synthetic_corpus(rag.doc_vecs, n)
+            index = load_vector_index(vecs, None)
+            syn = {"n_chunks": n, "index": index.kind, "stages": {
+                "top_k_sim": {str(c): _bench_stage(lambda q, v=vecs: top_k_sim(qvs[q], v, k), questions, c) for c in concurrency},
+                "search": {str(c): _bench_stage(lambda q, ix=index: ix.search(qvs[q], k), questions, c) for c in concurrency},
+            }}
+            report["synthetic"].append(syn)
+            print(f"⏱️ synthetic N={n} ({index.kind}): " + ", ".join(
+                f"{s} p50 {r[str(concurrency[0])]['p50_ms']:.2f}ms" for s, r in syn["stages"].items()))
+            del vecs, index  # free this corpus before the next size is generated
+    finally:
+        rag.query_cache, rag.answer_cache, rag.semantic_cache = saved
+    return report
+
+# --bench-lm: each CPU inference backend against the float32 baseline, greedy, on the prompts the
+# fixed question set retrieves: decode speed, per-answer latency, weight size, and agreement with
+# the float32 answers (exact match and token F1 over the generated ids)
+def _token_f1(a: List[int], b: List[int]) -> float:
+    if not a and not b:
+        return 1.0
+    common = sum((Counter(a) & Counter(b)).values())
+    if not common:
+        return 0.0
+    p, r = common / len(a), common / len(b)
+    return 2 * p * r / (p + r)
+
+def _model_mb(model) -> float:
+    qlin = torch.ao.nn.quantized.dynamic.Linear
+    n = sum(m.weight().numel() for m in model.modules() if isinstance(m, qlin))  # int8 weights
+    n += sum(p.numel() * p.element_size() for p in model.parameters())
+    return round(n / 2**20, 1)
+
+def bench_lm_backends(rag: SimplePDFRAG, backends=("float32", "int8", "compile", "int8,compile")) -> dict:
+    rag._ensure_lm_loaded()
+    prompts = [rag._build_prompt(q, rag._retrieve(q, {})[1], {}) for q in BENCH_QUESTIONS]
+    report = {"meta": {"timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"), "model": rag.mm.model_id,
+                       "device": config.DEVICE, "threads": torch.get_num_threads(), "prompts": len(prompts),
+                       "prompt_tokens": round(float(np.mean([len(p) for p in prompts])), 1),
+                       "max_new_tokens": config.MAX_NEW_TOKENS},
+              "backends": {}}
+    baseline = None
+    for backend in ["float32"] + [b for b in backends if b != "float32"]:
+        t0 = time.perf_counter()
+        if lm_backend_options(backend) == lm_backend_options(rag.mm.backend):
+            mm = rag.mm
+        else:
+            mm = SafeModelManager(rag.mm.model_id, backend)
+            mm.load()
+        load_s = time.perf_counter() - t0
+        if lm_backend_options(mm.backend) != lm_backend_options(backend):
+            report["backends"][backend] = {"error": f"backend failed to load (got {mm.backend})"}
+            mm.cleanup()
+            continue
+        kw = dict(generation_kwargs(mm.tok), do_sample=False)
+        kw.pop("temperature"); kw.pop("top_p")
+        outs, lat = [], []
+        for n, p in enumerate(prompts):
+            ids = torch.tensor([p], dtype=torch.long, device=mm.model.device)
+            if n == 0:  # warm-up: first-call allocations / compiled shapes
+                mm.model.generate(input_ids=ids, attention_mask=torch.ones_like(ids), **dict(kw, max_new_tokens=2))
+            t1 = time.perf_counter()
+            out = mm.model.generate(input_ids=ids, attention_mask=torch.ones_like(ids), **kw)
+            lat.append((time.perf_counter() - t1) * 1000)
+            outs.append(out[0, len(p):].tolist())
+        baseline = baseline or outs
+        n_tok = sum(len(o) for o in outs)
+        report["backends"][backend] = {
+            "load_s": round(load_s, 2),
+            "model_mb": _model_mb(mm.model),
+            "new_tokens": n_tok,
+            "tokens_per_s": round(n_tok / max(sum(lat) / 1000, 1e-9), 2),
+            "latency_ms": {"p50": round(float(np.percentile(lat, 50)), 1), "mean": round(float(np.mean(lat)), 1)},
+            "exact_match": round(float(np.mean([a == b for a, b in zip(outs, baseline)])), 3),
+            "token_f1": round(float(np.mean([_token_f1(a, b) for a, b in zip(outs, baseline)])), 3),
+        }
+        r = report["backends"][backend]
+        print(f"⏱️ {backend}: {r['tokens_per_s']} tok/s, p50 {r['latency_ms']['p50']}ms, {r['model_mb']} MB, "
+              f"exact {r['exact_match']}, token F1 {r['token_f1']} vs float32")
+        if mm is not rag.mm:
+            mm.cleanup()
+            del mm
+    base = report["backends"]["float32"]["tokens_per_s"]
+    for r in report["backends"].values():
+        if "tokens_per_s" in r:
+            r["speedup"] = round(r["tokens_per_s"] / max(base, 1e-9), 2)
+    return report
+
+# Where startup time goes: module imports (first-use, incremental: sentence_transformers includes
+# transformers) and each load step an --ask pays before answering.
+def profile_startup(rag: SimplePDFRAG, t_main: float) -> dict:
+    steps = {}
+    def step(name, fn):
+        t0 = time.perf_counter()
+        fn()
+        steps[name] = round((time.perf_counter() - t0) * 1000, 1)
+    step("load_index", rag.load_prebuilt_index)
+    step("load_embedder", lambda: rag.embedder)
+    step("embed_query", lambda: rag.embedder.embed_text("startup probe"))
+    step("load_lm", rag._ensure_lm_loaded)
+    return {"script_import_ms": round((t_main - _T_START) * 1000, 1), "imports_ms": dict(IMPORT_TIMES_MS),
+            "steps_ms": steps, "total_ms": round((time.perf_counter() - _T_START) * 1000, 1)}
+
+
 # ---------------- CLI ----------------
 def main():
+    t_main = time.perf_counter()
     parser = argparse.ArgumentParser(description="FAST Multi-PDF RAG")
+    parser.add_argument("--telemetry", type=str, default=config.TELEMETRY, help='Telemetry sinks: "log", "prometheus" or both, comma-separated')
+    parser.add_argument("--setup", action="store_true", help="Install missing dependencies and log in to the HuggingFace Hub")
+    parser.add_argument("--profile-startup", action="store_true", help="Report import and load times of the --ask startup path")
     parser.add_argument("--build", action="store_true", help="Build the index from PDFs in DATA_DIR")
+    parser.add_argument("--tenant", type=str, default=None, help="With --build: build this user's overlay from USER_DATA_DIR/<tenant>; "
+                                                                 "with --ask/REPL: also search it")
+    parser.add_argument("--data-dir", type=str, default=None, help="With --build: PDF directory (overrides DATA_DIR / USER_DATA_DIR)")
     parser.add_argument("--ask", type=str, default=None, help="Ask a single question and print the answer")
+    parser.add_argument("--stream", action="store_true", help="With --ask: print the answer as it is generated")
+    parser.add_argument("--rerank", action="store_true", help="Re-rank a larger candidate pool with a cross-encoder (RERANK)")
+    parser.add_argument("--bench-index", action="store_true", help="Report recall/latency of IVF and quantized search vs exact search")
+    parser.add_argument("--bench-queries", type=int, default=200, help="Number of queries for --bench-index")
+    parser.add_argument("--bench-lm", action="store_true", help="Compare CPU LM backends (int8, torch.compile) with float32")
+    parser.add_argument("--bench-lm-backends", type=str, default="float32,int8,compile,int8+compile",
+                        help="Comma-separated backends for --bench-lm; join options with + (int8+compile)")
+    parser.add_argument("--lm-backend", type=str, default=None, help="Override LM_BACKEND (e.g. int8 or int8,compile)")
+    parser.add_argument("--threads", type=int, default=None, help="Override TORCH_THREADS (default: auto)")
+    parser.add_argument("--bench-prefix", action="store_true", help="Report time-to-first-token with and without the prefix KV cache")
+    parser.add_argument("--bench", action="store_true", help="Benchmark embed/search/pack/generate/answer latency and throughput")
+    parser.add_argument("--bench-concurrency", type=str, default="1,4", help="Comma-separated concurrency levels for --bench")
+    parser.add_argument("--bench-corpus", type=str, default="", help="Comma-separated synthetic corpus sizes (chunks) for --bench")
+    parser.add_argument("--bench-repeat", type=int, default=1, help="Passes over the fixed query set per measurement")
+    parser.add_argument("--bench-no-gen", action="store_true", help="Skip the generation stages in --bench")
+    parser.add_argument("--bench-out", type=str, default=None, help="JSON output path for --bench (default: CACHE_DIR/bench/)")
+    parser.add_argument("--serve", action="store_true", help="Run a long-lived JSON HTTP server around one warm RAG")
+    parser.add_argument("--host", type=str, default=config.SERVE_HOST, help="Bind address for --serve")
+    parser.add_argument("--port", type=int, default=config.SERVE_PORT, help="Port for --serve")
     args = parser.parse_args()
 
     print("🚀 FAST Multi-PDF RAG")
-    setup_torch()
+    telemetry.configure(args.telemetry, config.TELEMETRY_LOG_PATH)
+    if args.rerank:
+        config.RERANK = True
+    if args.lm_backend is not None:
+        config.LM_BACKEND = args.lm_backend
+    if args.threads:
+        config.TORCH_THREADS = args.threads  # applied by setup_torch when torch is first imported
+    if args.setup:
+        run_setup()
+        return
     rag = SimplePDFRAG()
 
+    if args.profile_startup:
+        print(json.dumps(profile_startup(rag, t_main), indent=2))
+        return
+
     if args.build:
-        rag.build_index()
+        rag.build_index(args.tenant, args.data_dir)
+        return
+
+    if args.serve:
+        serve(rag, args.host, args.port)
         return
 
     # runtime: load latest prebuilt index
     rag.load_prebuilt_index()
+
+    if args.bench_index:
+        print(json.dumps(bench_vector_index(rag.doc_vecs, rag.index_path, n_queries=args.bench_queries), indent=2))
+        return
+
+    if args.bench:
+        ints = lambda s: [int(x) for x in s.split(",") if x.strip()]
+        report = run_benchmarks(rag, ints(args.bench_concurrency), ints(args.bench_corpus),
+                                args.bench_repeat, generation=not args.bench_no_gen)
+        out = args.bench_out or os.path.join(config.CACHE_DIR, "bench", f"bench-{time.strftime('%Y%m%d-%H%M%S')}.json")
+        os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+        with open(out, "w") as f:
+            json.dump(report, f, indent=2)
+        print("🧾 Benchmark written:", out)
+        rag.cleanup()
+        return
     
     # Preload model for faster responses (only if not already loaded)
     if not rag._model_loaded:
         print("🔄 Preloading model for faster responses...")
         rag._ensure_lm_loaded()
 
+    if args.bench_prefix:
+        print(json.dumps(rag.bench_prefix(), indent=2))
+        return
+
+    if args.bench_lm:
+        report = bench_lm_backends(rag, [b.replace("+", ",") for b in args.bench_lm_backends.split(",") if b.strip()])
+        out = args.bench_out or os.path.join(config.CACHE_DIR, "bench", f"bench-lm-{time.strftime('%Y%m%d-%H%M%S')}.json")
+        os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+        with open(out, "w") as f:
+            json.dump(report, f, indent=2)
+        print("🧾 Benchmark written:", out)
+        rag.cleanup()
+        return
+
     if args.ask:
-        print("A:", rag.answer(args.ask))
+        if args.stream:
+            print("A: ", end="", flush=True)
+            for piece in rag.stream_answer(args.ask, args.tenant):
+                print(piece, end="", flush=True)
+            print()
+        else:
+            print("A:", rag.answer(args.ask, args.tenant))
         rag.cleanup()
         return
 
@@ -549,7 +3667,7 @@ def main():
             break
         if q.lower() in {"exit","quit","q"}:
             break
-        print("A:", rag.answer(q), "\n")
+        print("A:", rag.answer(q, args.tenant), "\n")
 
     rag.cleanup()
     print("👋 Done.")